@@ -0,0 +1,331 @@
+"""
+benchmarks for the phenotype scorers and BIDS table operations.
+
+synthetic Likert exports (every instrument and order) and synthetic BIDS trees
+(N subjects x M phenotype files) are generated in a temp folder; every case is
+timed (best of --repeat runs) and its peak traced memory recorded.
+
+usage:
+python benchmarks/run_benchmarks.py                   # run, print results
+python benchmarks/run_benchmarks.py --save-baseline   # store as baseline
+python benchmarks/run_benchmarks.py --compare         # fail on regressions
+python benchmarks/run_benchmarks.py --quick           # small sizes only
+python benchmarks/run_benchmarks.py --check-imports   # import budget only
+
+light modules over the --import-budget (or loading pandas / numpy /
+bids_validator) fail the run in every mode.
+"""
+
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import platform
+import contextlib
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from eegmanylabs_bids import bids_eeg, bids_utils  # noqa: E402
+from eegmanylabs_bids.bids_init import init_folder  # noqa: E402
+from eegmanylabs_bids.bids_phenotype import (  # noqa: E402
+    pheno_dtypes,
+    scoring_specs,
+    score_questionnaire,
+)
+
+default_baseline = Path(__file__).parent / "baseline.json"
+
+# modules that are cheap to import for short-lived hooks, and the heavy
+# dependencies they must not pull in at import time
+light_modules = [
+    "eegmanylabs_bids.bids_init",
+    "eegmanylabs_bids.bids_utils",
+    "eegmanylabs_bids.bids_eeg",
+]
+heavy_modules = ["pandas", "numpy", "bids_validator"]
+
+
+# synthetic data
+def make_export(n_rows, seed=0, missing=0.05):
+    """
+    raw questionnaire export with the items of every instrument
+    """
+    rng = np.random.default_rng(seed)
+    columns = {"participant_id": [f"sub-ab{i:07d}" for i in range(n_rows)]}
+    for spec in scoring_specs.values():
+        low, high = spec["range"]
+        for k in spec["items"]:
+            if k in columns:
+                continue
+            values = rng.integers(low, high + 1, n_rows).astype(np.float64)
+            values[rng.random(n_rows) < missing] = np.nan
+            columns[k] = values
+    return pd.DataFrame(columns)
+
+
+def make_bids(BIDS_root, n_subjects, n_pheno, seed=0):
+    """
+    BIDS tree with n_subjects eeg folders (one sidecar each) and n_pheno
+    phenotype tables
+    """
+    rng = np.random.default_rng(seed)
+    init_folder(BIDS_root)
+    participant_ids = [f"sub-ab{i:05d}" for i in range(n_subjects)]
+    pd.DataFrame(
+        {
+            "participant_id": participant_ids[::-1],
+            "species": "homo sapiens",
+            "age": rng.integers(18, 70, n_subjects),
+            "sex": "f",
+            "handedness": "r",
+            "replication": "n/a",
+            "lab": "ab",
+        }
+    ).to_csv(BIDS_root / "participants.tsv", sep="\t", index=False)
+
+    pheno_names = list(pheno_dtypes) + [
+        f"extra_{i}" for i in range(max(0, n_pheno - len(pheno_dtypes)))
+    ]
+    for pheno_name in pheno_names[:n_pheno]:
+        columns = list(pheno_dtypes.get(pheno_name, {})) or ["score"]
+        table = {"participant_id": participant_ids[::-1]}
+        for column in columns:
+            table[column] = rng.integers(0, 50, n_subjects)
+        pd.DataFrame(table).to_csv(
+            BIDS_root / "phenotype" / f"{pheno_name}.tsv", sep="\t", index=False
+        )
+
+    sidecar = {
+        "SamplingFrequency": 500,
+        "PowerLineFrequency": 50,
+        "EEGReference": "Cz",
+        "SoftwareFilters": "n/a",
+    }
+    for participant_id in participant_ids:
+        eeg_folder = BIDS_root / participant_id / "eeg"
+        eeg_folder.mkdir(parents=True)
+        (eeg_folder / f"{participant_id}_task-rest_eeg.json").write_text(
+            json.dumps(sidecar)
+        )
+    return participant_ids
+
+
+# measurement
+def measure(func, setup=None, repeat=3):
+    """
+    best wall time (s) over repeat runs, and peak traced memory (MB) of one run.
+    setup() is called before every run and its result passed to func.
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            func(arg)
+            times.append(time.perf_counter() - t0)
+
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"time": min(times), "memory": peak / 1e6}
+
+
+# benchmark cases
+def bench_scorers(sizes, repeat):
+    results = {}
+    for n_rows in sizes:
+        data = make_export(n_rows)
+        for (questionnaire, order), spec in scoring_specs.items():
+            for lean in [False, True]:
+                name = f"score/{questionnaire}/{order}/{'lean' if lean else 'float'}"
+                results[f"{name}/{n_rows}"] = measure(
+                    lambda _, q=questionnaire, o=order, lean=lean: score_questionnaire(
+                        data, q, order=o, lean=lean
+                    ),
+                    repeat=repeat,
+                )
+    return results
+
+
+def bench_bids(trees, repeat, tmp):
+    results = {}
+    for n_subjects, n_pheno in trees:
+        template = tmp / f"template_{n_subjects}_{n_pheno}"
+        participant_ids = make_bids(template, n_subjects, n_pheno)
+        work = tmp / "work"
+
+        def fresh():
+            if work.exists():
+                shutil.rmtree(work)
+            shutil.copytree(template, work)
+            return work
+
+        size = f"{n_subjects}x{n_pheno}"
+        cases = {
+            "add_participant": lambda root: bids_utils.add_participant(
+                root, "sub-zz00001", lab="zz"
+            ),
+            "drop_participant": lambda root: bids_utils.drop_participant(
+                root, participant_ids[0]
+            ),
+            "sort_bids": lambda root: bids_utils.sort_bids(root),
+            "consolidate_bids": lambda root: bids_utils.consolidate_bids(root),
+            "validate_bids": lambda root: bids_utils.check_bids(root, cache=False),
+            "update_eeg_json": lambda root: bids_eeg.update_eeg_json(
+                root, participant_ids[0], "rest"
+            ),
+            "update_eeg_jsons": lambda root: bids_eeg.update_eeg_jsons(
+                root, verbose=False
+            ),
+        }
+        for name, func in cases.items():
+            results[f"bids/{name}/{size}"] = measure(func, setup=fresh, repeat=repeat)
+    return results
+
+
+def bench_imports(repeat):
+    """
+    import time (s) of the light modules in a fresh interpreter, and the
+    heavy modules loaded with them
+    """
+    results = {}
+    code = (
+        "import sys, time, json; t0 = time.perf_counter(); import {module}; "
+        "print(json.dumps([time.perf_counter() - t0, "
+        "[m for m in {heavy} if m in sys.modules]]))"
+    )
+    root = str(Path(__file__).resolve().parents[1])
+    for module in light_modules:
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", code.format(module=module, heavy=heavy_modules)],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=root,
+            ).stdout
+            import_time, loaded = json.loads(out)
+            times.append(import_time)
+        results[f"import/{module}"] = {"time": min(times), "memory": 0.0}
+        results[f"import/{module}"]["heavy"] = loaded
+    return results
+
+
+def check_import_budget(results, budget):
+    """
+    names of light modules over the import time budget or loading heavy modules
+    """
+    failures = []
+    for name, result in sorted(results.items()):
+        if not name.startswith("import/"):
+            continue
+        if result["time"] > budget or result["heavy"]:
+            print(
+                f"{name}: {result['time'] * 1e3:.1f} ms (budget {budget * 1e3:.0f} ms)"
+                f", heavy modules loaded: {result['heavy']}"
+            )
+            failures.append(name)
+    return failures
+
+
+def compare(results, baseline, tolerance):
+    """
+    print results next to the baseline, return the names of regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        line = f"{name:60s} {result['time'] * 1e3:10.2f} ms {result['memory']:9.2f} MB"
+        if base is not None:
+            ratio = result["time"] / max(base["time"], 1e-9)
+            line += f"  x{ratio:5.2f} vs baseline"
+            if ratio > 1 + tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="small sizes only")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", type=Path, default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown counted as regression (default 0.25)",
+    )
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=0.1,
+        help="max import time (s) of the light modules (default 0.1)",
+    )
+    parser.add_argument(
+        "--check-imports",
+        action="store_true",
+        help="only time the light module imports against --import-budget",
+    )
+    parser.add_argument("--output", type=Path, help="write results as json")
+    args = parser.parse_args(argv)
+    if args.check_imports and args.save_baseline:
+        parser.error("--save-baseline needs the full run, not --check-imports")
+
+    if args.quick:
+        sizes, trees = [10**3, 10**4], [(50, 3), (200, 7)]
+    else:
+        sizes = [10**3, 10**4, 10**5, 10**6]
+        trees = [(100, 7), (1000, 7), (5000, 20)]
+
+    results = bench_imports(args.repeat)
+    if not args.check_imports:
+        with tempfile.TemporaryDirectory() as tmp:
+            results.update(bench_scorers(sizes, args.repeat))
+            results.update(bench_bids(trees, args.repeat, Path(tmp)))
+
+    baseline = {}
+    if args.baseline.is_file():
+        baseline = json.loads(args.baseline.read_text())["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    over_budget = check_import_budget(results, args.import_budget)
+
+    record = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(record, indent=2))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(record, indent=2))
+        print(f"baseline saved to {args.baseline}")
+    if over_budget:
+        print(f"{len(over_budget)} light module(s) over the import budget")
+    if args.compare and regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+    if over_budget or (args.compare and regressions):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+build the BIDS phenotype folder from raw per-lab questionnaire exports.
+each lab export is read and scored in its own worker process, the results
+are concatenated per phenotype file and keyed by participant_id.
+
+usage:
+python -m eegmanylabs_bids.bids_build BIDS_root --source ab=ab_export.csv \
+    --source cd=cd_export.tsv --order bfi_s15=ger-1 --order bisbas=general
+"""
+
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from .bids_init import get_template
+from .bids_trace import traced, count, record, disable_tracing
+from .bids_utils import BIDSDataset, atomic_write
+from .bids_phenotype import (
+    pheno_dtypes,
+    score_phenotype,
+    scoring_specs,
+    scoring_spec_version,
+    validate_questionnaires,
+)
+
+# phenotype cache eviction defaults
+max_cache_size = 1024**3  # bytes
+max_cache_age = 30 * 24 * 3600  # seconds
+
+
+def _export_sep(source):
+    return "\t" if Path(source).suffix == ".tsv" else ","
+
+
+@traced
+def read_export(source, chunksize=None, id_column="participant_id"):
+    """
+    read a raw questionnaire export (.csv or .tsv).
+    only the id column and questionnaire item columns are loaded; with
+    chunksize, an iterator of DataFrames with chunksize rows is returned.
+    """
+    sep = _export_sep(source)
+    header = pd.read_csv(source, sep=sep, nrows=0).columns
+    items = {k for spec in scoring_specs.values() for k in spec["items"]}
+    usecols = [k for k in header if k == id_column or k in items]
+    count(files_read=1, bytes_read=Path(source).stat().st_size)
+    return pd.read_csv(source, sep=sep, usecols=usecols, chunksize=chunksize)
+
+
+def _score_chunk(data, orders, skipna, id_column, lean=False, min_items=None):
+    assert id_column in data.keys()
+    participant_ids = data[id_column].astype(str)
+    participant_ids = participant_ids.where(
+        participant_ids.str.startswith("sub-"), "sub-" + participant_ids
+    )
+
+    if not lean:
+        data = validate_questionnaires(data)
+    phenotype = score_phenotype(
+        data, orders=orders, skipna=skipna, lean=lean, min_items=min_items
+    )
+    for pheno_name, scores in phenotype.items():
+        if skipna or min_items is not None:
+            # missing items imputed at the center (e.g. 2.5 for STAI) or
+            # prorated give fractional scores: round half up to fit the
+            # integer phenotype columns
+            columns = [k for k in pheno_dtypes[pheno_name] if k in scores.keys()]
+            scores[columns] = np.floor(scores[columns].astype(np.float64) + 0.5)
+        scores.insert(0, "participant_id", participant_ids)
+    return phenotype
+
+
+def score_stream(
+    source,
+    orders=None,
+    skipna=False,
+    id_column="participant_id",
+    chunksize=10000,
+    lean=False,
+    min_items=None,
+):
+    """
+    score an export chunk by chunk, keeping memory bounded by chunksize.
+    source is a .csv/.tsv path or an iterable of DataFrames.
+    yields {phenotype file name: DataFrame with participant_id column}
+    per chunk. lean and min_items are passed to score_questionnaire; with
+    skipna or min_items, fractional scores are rounded half up.
+    """
+    if isinstance(source, (str, Path)):
+        source = read_export(source, chunksize=chunksize, id_column=id_column)
+    for chunk in source:
+        yield _score_chunk(chunk, orders, skipna, id_column, lean, min_items)
+
+
+@traced
+def score_to_tsv(
+    source,
+    output_folder,
+    orders=None,
+    skipna=False,
+    id_column="participant_id",
+    chunksize=10000,
+    lean=False,
+    min_items=None,
+):
+    """
+    stream-score an export (see score_stream) and append the results to
+    output_folder/<phenotype file name>.tsv, chunk by chunk.
+    returns the number of rows written per phenotype file.
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    n_rows = {}
+    stream = score_stream(source, orders, skipna, id_column, chunksize, lean, min_items)
+    for phenotype in stream:
+        for pheno_name, scores in phenotype.items():
+            scores.astype(pheno_dtypes[pheno_name]).to_csv(
+                output_folder / f"{pheno_name}.tsv",
+                sep="\t",
+                index=False,
+                na_rep="n/a",
+                mode="a" if pheno_name in n_rows else "w",
+                header=pheno_name not in n_rows,
+            )
+            n_rows[pheno_name] = n_rows.get(pheno_name, 0) + len(scores)
+            count(rows_written=len(scores))
+    return n_rows
+
+
+@traced
+def score_lab(
+    source,
+    orders=None,
+    skipna=False,
+    id_column="participant_id",
+    chunksize=None,
+    lean=False,
+    min_items=None,
+):
+    """
+    read, validate and score one lab export.
+    with chunksize, the export is scored in chunks (see score_stream).
+    returns {phenotype file name: DataFrame with participant_id column}
+    """
+    if chunksize is None:
+        return _score_chunk(
+            read_export(source, id_column=id_column),
+            orders,
+            skipna,
+            id_column,
+            lean,
+            min_items,
+        )
+
+    results = {}
+    stream = score_stream(source, orders, skipna, id_column, chunksize, lean, min_items)
+    for phenotype in stream:
+        for pheno_name, scores in phenotype.items():
+            results.setdefault(pheno_name, []).append(scores)
+    return {
+        pheno_name: pd.concat(scores, ignore_index=True)
+        for pheno_name, scores in results.items()
+    }
+
+
+def _score_lab_timed(*args, **kwargs):
+    """
+    score_lab in a worker process, returns (result, wall time in s).
+    spans of the worker would be lost, the caller records one per lab.
+    """
+    disable_tracing()
+    t0 = time.perf_counter()
+    result = score_lab(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def _cache_key(source, orders, skipna, id_column, lean=False, min_items=None):
+    """
+    hash of the export content, the scoring arguments and the scoring specs
+    """
+    h = hashlib.sha256()
+    with Path(source).open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(
+        json.dumps(
+            {
+                "scorer": "score_lab",
+                "orders": orders,
+                "skipna": skipna,
+                "id_column": id_column,
+                "lean": lean,
+                "min_items": min_items,
+                "version": scoring_spec_version,
+                "specs": repr(sorted(scoring_specs.items())),
+            },
+            sort_keys=True,
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+def _write_cached_scores(file, scores):
+    """
+    write {phenotype name: DataFrame} as json: columns, dtypes and rows.
+    a data-only format, so a file planted in a shared cache cannot run code.
+    """
+    tables = {
+        name: {
+            "columns": list(table.keys()),
+            "dtypes": {
+                k: (
+                    {"categories": list(v.categories), "ordered": v.ordered}
+                    if isinstance(v, pd.CategoricalDtype)
+                    else str(v)
+                )
+                for k, v in table.dtypes.items()
+            },
+            "rows": table.astype(object).where(table.notna(), None).values.tolist(),
+        }
+        for name, table in scores.items()
+    }
+    atomic_write(file, lambda tmp: tmp.write_text(json.dumps(tables)))
+
+
+def _read_cached_scores(file):
+    """
+    {phenotype name: DataFrame} written by _write_cached_scores, None if the
+    file cannot be read as such
+    """
+    try:
+        tables = json.loads(file.read_text())
+        scores = {}
+        for name, t in tables.items():
+            dtypes = {
+                k: pd.CategoricalDtype(**v) if isinstance(v, dict) else v
+                for k, v in t["dtypes"].items()
+            }
+            table = pd.DataFrame(t["rows"], columns=t["columns"])
+            scores[name] = table.astype(dtypes)
+        return scores
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+@traced
+def evict_cache(cache_dir, max_size=max_cache_size, max_age=max_cache_age):
+    """
+    delete cached scores older than max_age seconds, then the least recently
+    used ones until the cache is smaller than max_size bytes
+    """
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        return
+    now = time.time()
+    entries = []
+    # scores cached as pickles by earlier versions are never loaded
+    for entry in cache_dir.glob("*.pkl"):
+        entry.unlink()
+    for entry in cache_dir.glob("*.json"):
+        stat = entry.stat()
+        if now - stat.st_mtime > max_age:
+            entry.unlink()
+        else:
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    size = sum(e[1] for e in entries)
+    for _, entry_size, entry in sorted(entries):
+        if size <= max_size:
+            break
+        entry.unlink()
+        size -= entry_size
+
+
+@traced
+def build_phenotype(
+    BIDS_root,
+    sources,
+    orders=None,
+    skipna=False,
+    id_column="participant_id",
+    n_jobs=None,
+    cache_dir=None,
+    force=False,
+    lean=False,
+    min_items=None,
+    orders_by_lab=None,
+):
+    """
+    score all lab exports and write phenotype/*.tsv (plus json sidecars).
+
+    sources maps lab names to export files. orders {questionnaire: order} is
+    used for all labs; orders_by_lab {lab: {questionnaire: order}} gives the
+    orders per lab (on top of orders) and must list every lab in sources.
+    labs are processed in parallel by a process pool with n_jobs workers
+    (default: one per CPU). lean and min_items are passed to
+    score_questionnaire; with skipna or min_items, fractional scores are
+    rounded half up.
+
+    scores are cached per lab as json in cache_dir (default:
+    derivatives/phenotype_cache), keyed by a hash of the export content,
+    the scoring arguments and the scoring specs. only labs whose key changed
+    are re-scored; force=True re-scores all labs. cache_dir=False disables
+    the cache.
+    returns {phenotype file name: DataFrame} as written to disk.
+    """
+    orders = orders or {}
+    if any(isinstance(v, dict) for v in orders.values()):
+        raise TypeError("orders maps questionnaires to orders, use orders_by_lab")
+    if orders_by_lab is None:
+        orders = {lab: orders for lab in sources}
+    else:
+        missing = [lab for lab in sources if lab not in orders_by_lab]
+        if missing:
+            raise KeyError(f"no orders_by_lab entry for lab(s) {missing}")
+        orders = {lab: dict(orders, **orders_by_lab[lab]) for lab in sources}
+
+    BIDS_root = Path(BIDS_root)
+    if cache_dir is None:
+        cache_dir = BIDS_root / "derivatives" / "phenotype_cache"
+    cache_files = {}
+    results = {}
+    if cache_dir is not False:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for lab, source in sources.items():
+            key = _cache_key(source, orders[lab], skipna, id_column, lean, min_items)
+            cache_files[lab] = cache_dir / f"{key}.json"
+            if cache_files[lab].is_file() and not force:
+                cached = _read_cached_scores(cache_files[lab])
+                if cached is not None:
+                    results[lab] = cached
+                    cache_files[lab].touch()
+                    print(f"{lab}: using cached scores")
+    todo = {lab: source for lab, source in sources.items() if lab not in results}
+    count(labs=len(sources), labs_cached=len(sources) - len(todo))
+
+    if n_jobs == 1 or len(todo) < 2:
+        for lab, source in todo.items():
+            results[lab] = score_lab(
+                source, orders[lab], skipna, id_column, lean=lean, min_items=min_items
+            )
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {
+                lab: pool.submit(
+                    _score_lab_timed,
+                    source,
+                    orders[lab],
+                    skipna,
+                    id_column,
+                    lean=lean,
+                    min_items=min_items,
+                )
+                for lab, source in todo.items()
+            }
+            for lab, future in futures.items():
+                results[lab], seconds = future.result()
+                record(
+                    f"bids_build.score_lab[{lab}]",
+                    seconds,
+                    rows=max((len(t) for t in results[lab].values()), default=0),
+                )
+
+    if cache_files:
+        for lab in todo:
+            _write_cached_scores(cache_files[lab], results[lab])
+        evict_cache(cache_dir)
+    results = {lab: results[lab] for lab in sources}
+
+    phenotype = {}
+    for pheno_name in pheno_dtypes:
+        tables = [r[pheno_name] for r in results.values() if pheno_name in r]
+        if not tables:
+            continue
+        table = pd.concat(tables, ignore_index=True)
+        table.sort_values("participant_id", inplace=True, ignore_index=True)
+        phenotype[pheno_name] = table.astype(pheno_dtypes[pheno_name])
+
+    (BIDS_root / "phenotype").mkdir(exist_ok=True)
+    with BIDSDataset(BIDS_root) as dataset:
+        for pheno_name, table in phenotype.items():
+            dataset.set_table(f"phenotype/{pheno_name}.tsv", table)
+            pheno_json = get_template()["phenotype_jsons"].get(pheno_name.upper())
+            if pheno_json is not None:
+                dataset.set_sidecar(f"phenotype/{pheno_name}.json", pheno_json)
+
+    for pheno_name, table in phenotype.items():
+        print(f"phenotype/{pheno_name}.tsv written ({len(table)} participants)")
+    return phenotype
+
+
+def _key_value(arg):
+    key, sep, value = arg.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got '{arg}'")
+    return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="build BIDS phenotype tables from raw lab questionnaire exports"
+    )
+    parser.add_argument("BIDS_root", type=Path)
+    parser.add_argument(
+        "--source",
+        type=_key_value,
+        action="append",
+        required=True,
+        metavar="LAB=FILE",
+        help="raw export of one lab (.csv/.tsv), can be repeated",
+    )
+    parser.add_argument(
+        "--order",
+        type=_key_value,
+        action="append",
+        default=[],
+        metavar="QUESTIONNAIRE=ORDER",
+        help="item order of a questionnaire for all labs, can be repeated",
+    )
+    parser.add_argument(
+        "--orders-json",
+        type=Path,
+        help="json file with per-lab orders {lab: {questionnaire: order}}, "
+        "one entry per --source lab (on top of --order)",
+    )
+    parser.add_argument("--id-column", default="participant_id")
+    parser.add_argument("--skipna", action="store_true")
+    parser.add_argument(
+        "--min-items",
+        type=lambda v: float(v) if "." in v else int(v),
+        default=None,
+        help="prorate subscales with at least this many (or this fraction of) "
+        "items present",
+    )
+    parser.add_argument(
+        "--lean", action="store_true", help="exact integer scoring with int8 items"
+    )
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=None,
+        help="phenotype score cache (default: BIDS_root/derivatives/phenotype_cache)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not read or write the cache"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="re-score all labs, ignoring the cache"
+    )
+    args = parser.parse_args(argv)
+
+    orders_by_lab = None
+    if args.orders_json is not None:
+        orders_by_lab = json.loads(args.orders_json.read_text())
+    build_phenotype(
+        args.BIDS_root,
+        dict(args.source),
+        orders=dict(args.order),
+        orders_by_lab=orders_by_lab,
+        skipna=args.skipna,
+        id_column=args.id_column,
+        n_jobs=args.jobs,
+        cache_dir=False if args.no_cache else args.cache_dir,
+        force=args.force,
+        lean=args.lean,
+        min_items=args.min_items,
+    )
+
+
+if __name__ == "__main__":
+    main()
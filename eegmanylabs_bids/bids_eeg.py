@@ -7,10 +7,43 @@ d.welke@leeds.ac.uk
 https://github.com/dominikwelke
 """
 
-from eegmanylabs_bids.bids_init import BIDS_template
+from eegmanylabs_bids.bids_init import get_template
+from eegmanylabs_bids.bids_utils import atomic_write
+from eegmanylabs_bids.bids_trace import traced, count
+import re
 import json
 
+from concurrent.futures import ThreadPoolExecutor
 
+# fields every lab should record identically across its sidecars (audit)
+lab_consistent_fields = [
+    "SamplingFrequency",
+    "PowerLineFrequency",
+    "EEGReference",
+    "EEGChannelCount",
+]
+
+
+def _merge_sidecar(eeg_sidecar_old, template_items, overrides):
+    """
+    merge a sidecar with the template items, then apply overrides.
+    returns the merged sidecar and the keys that were dropped.
+    """
+    # small fixes
+    if "RecordingInstitution" in eeg_sidecar_old.keys():
+        eeg_sidecar_old["InstitutionName"] = eeg_sidecar_old["RecordingInstitution"]
+
+    # merge
+    eeg_sidecar_new = {k: eeg_sidecar_old.get(k, v) for k, v in template_items}
+    ignored = [k for k in eeg_sidecar_old.keys() if k not in eeg_sidecar_new.keys()]
+
+    for k, v in overrides.items():
+        if k in eeg_sidecar_new.keys():
+            eeg_sidecar_new[k] = v
+    return eeg_sidecar_new, ignored
+
+
+@traced
 def update_eeg_json(BIDS_root, participant_id, task, **kwargs):
     """
     merge existing sidecar with our template.
@@ -25,30 +58,236 @@ def update_eeg_json(BIDS_root, participant_id, task, **kwargs):
     with eeg_sidecar_file.open("r") as f:
         eeg_sidecar_old = json.load(f)
 
-    # small fixes
-    if "RecordingInstitution" in eeg_sidecar_old.keys():
-        eeg_sidecar_old["InstitutionName"] = eeg_sidecar_old["RecordingInstitution"]
-
     # merge
-    eeg_sidecar_new = {
-        k: (eeg_sidecar_old[k] if (k in eeg_sidecar_old.keys()) else v)
-        for k, v in BIDS_template["eeg_json"].items()
-    }
-    _ = [
+    eeg_sidecar_new, ignored = _merge_sidecar(
+        eeg_sidecar_old, get_template()["eeg_json"].items(), kwargs
+    )
+    for k in ignored:
         print(
             f"entry '{k}' was present in sidecar, but not requested by BIDS template! - ignored"
         )
-        for k in eeg_sidecar_old.keys()
-        if k not in eeg_sidecar_new.keys()
-    ]
-
-    for k, v in kwargs.items():
-        if k in eeg_sidecar_new.keys():
-            eeg_sidecar_new[k] = v
 
     # check results
     assert sum([v == "REQUIRED" for v in eeg_sidecar_new.values()]) == 0
 
     # save new file
-    with eeg_sidecar_file.open("w") as f:
-        json.dump(eeg_sidecar_new, f, indent=4)
+    text = json.dumps(eeg_sidecar_new, indent=4)
+    atomic_write(eeg_sidecar_file, lambda tmp: tmp.write_text(text))
+
+
+@traced
+def find_eeg_jsons(BIDS_root, tasks=None):
+    """
+    all sub-*/eeg/*_eeg.json sidecars, optionally only of the given tasks
+    """
+    eeg_sidecar_files = sorted(BIDS_root.glob("sub-*/eeg/*_eeg.json"))
+    if tasks is not None:
+        tasks = {tasks} if isinstance(tasks, str) else set(tasks)
+        eeg_sidecar_files = [
+            f for f in eeg_sidecar_files if _sidecar_entities(f)[1] in tasks
+        ]
+    return eeg_sidecar_files
+
+
+def _sidecar_entities(eeg_sidecar_file):
+    """
+    participant_id and task of a sidecar file name
+    """
+    participant_id = eeg_sidecar_file.name.split("_")[0]
+    task = re.search(r"_task-([a-zA-Z0-9]+)", eeg_sidecar_file.name)
+    return participant_id, (task.group(1) if task else None)
+
+
+def _update_eeg_json_file(eeg_sidecar_file, template_items, overrides):
+    text_old = eeg_sidecar_file.read_text()
+    eeg_sidecar_new, ignored = _merge_sidecar(
+        json.loads(text_old), template_items, overrides
+    )
+    text_new = json.dumps(eeg_sidecar_new, indent=4)
+    missing = [k for k, v in eeg_sidecar_new.items() if v == "REQUIRED"]
+    updated = text_new != text_old
+    if updated:
+        atomic_write(eeg_sidecar_file, lambda tmp: tmp.write_text(text_new))
+    return updated, missing, ignored
+
+
+@traced
+def update_eeg_jsons(
+    BIDS_root, tasks=None, overrides_by_lab=None, n_jobs=None, verbose=True, **kwargs
+):
+    """
+    merge all eeg sidecars (optionally only of some tasks) with our template.
+
+    kwargs are applied to every sidecar, overrides_by_lab maps lab names (as in
+    the 'lab' column of participants.tsv) to fields applied to that lab only.
+    files are processed by a thread pool with n_jobs workers and only written
+    if their content changes. nothing is raised for missing REQUIRED fields;
+    returns one report DataFrame (a row per sidecar) instead.
+    """
+    import pandas as pd
+
+    if overrides_by_lab is None:
+        overrides_by_lab = {}
+    template_items = list(get_template()["eeg_json"].items())
+
+    labs = {}
+    if overrides_by_lab:
+        participants = pd.read_csv(BIDS_root / "participants.tsv", sep="\t")
+        labs = dict(zip(participants["participant_id"], participants["lab"]))
+
+    eeg_sidecar_files = find_eeg_jsons(BIDS_root, tasks=tasks)
+    entities = [_sidecar_entities(f) for f in eeg_sidecar_files]
+    overrides = [
+        dict(kwargs, **overrides_by_lab.get(labs.get(participant_id), {}))
+        for participant_id, _ in entities
+    ]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(
+            pool.map(
+                _update_eeg_json_file,
+                eeg_sidecar_files,
+                [template_items] * len(eeg_sidecar_files),
+                overrides,
+            )
+        )
+
+    count(
+        files=len(eeg_sidecar_files),
+        files_written=sum(r[0] for r in results),
+    )
+    report = pd.DataFrame(
+        {
+            "file": [str(f.relative_to(BIDS_root)) for f in eeg_sidecar_files],
+            "participant_id": [e[0] for e in entities],
+            "task": [e[1] for e in entities],
+            "updated": [r[0] for r in results],
+            "missing_required": [r[1] for r in results],
+            "ignored": [r[2] for r in results],
+        }
+    )
+    if verbose:
+        n_missing = sum(len(r[1]) > 0 for r in results)
+        print(
+            f"{report.updated.sum()} of {len(report)} eeg sidecars updated, "
+            f"{n_missing} with missing REQUIRED fields"
+        )
+    return report
+
+
+def _load_sidecar(eeg_sidecar_file):
+    sidecar = json.loads(eeg_sidecar_file.read_text())
+    return {
+        k: json.dumps(v, sort_keys=True) if isinstance(v, (dict, list)) else v
+        for k, v in sidecar.items()
+    }
+
+
+@traced
+def load_eeg_jsons(BIDS_root, tasks=None, n_jobs=None):
+    """
+    all eeg sidecars (optionally only of some tasks) as one table, read by a
+    thread pool with n_jobs workers. one row per sidecar with columns file,
+    participant_id, task and one column per field (nan if absent); nested
+    values (lists, objects) are stored as json strings. without sidecars the
+    table is empty, with the (object) columns file, participant_id and task.
+    """
+    import pandas as pd
+
+    eeg_sidecar_files = find_eeg_jsons(BIDS_root, tasks=tasks)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        sidecars = list(pool.map(_load_sidecar, eeg_sidecar_files))
+    count(files_read=len(eeg_sidecar_files))
+
+    entities = [_sidecar_entities(f) for f in eeg_sidecar_files]
+    table = pd.DataFrame(
+        {
+            "file": [str(f.relative_to(BIDS_root)) for f in eeg_sidecar_files],
+            "participant_id": [e[0] for e in entities],
+            "task": [e[1] for e in entities],
+        },
+        dtype=object,
+    )
+    return pd.concat([table, pd.DataFrame.from_records(sidecars)], axis=1)
+
+
+def _lab_mode_mismatch(table, field):
+    """
+    rows whose value of field differs from the most common value in their lab
+    """
+    counts = table.groupby(["lab", field], dropna=False).size().rename("n")
+    counts = counts.reset_index().sort_values("n", ascending=False, kind="stable")
+    mode = counts.drop_duplicates("lab").set_index("lab")[field]
+    expected = table["lab"].map(mode)
+    values = table[field]
+    return ~(values.eq(expected) | (values.isna() & expected.isna()))
+
+
+@traced
+def audit_eeg_jsons(
+    BIDS_root,
+    tasks=None,
+    consistent_fields=lab_consistent_fields,
+    n_jobs=None,
+    verbose=True,
+):
+    """
+    read-only check of all eeg sidecars against our template (nothing is
+    written or raised). returns one report DataFrame with a row per sidecar:
+        missing_required: REQUIRED template fields absent or still 'REQUIRED'
+        not_in_template:  fields the template does not have
+        inconsistent:     consistent_fields whose value differs from the most
+                          common one of the participant's lab
+        ok:               none of the above
+    the lab is taken from participants.tsv (first 3 characters of the label
+    if not listed there).
+    """
+    import numpy as np
+    import pandas as pd
+
+    template = get_template()["eeg_json"]
+    table = load_eeg_jsons(BIDS_root, tasks=tasks, n_jobs=n_jobs)
+    meta = ["file", "participant_id", "task"]
+
+    labs = {}
+    participants_file = BIDS_root / "participants.tsv"
+    if participants_file.is_file():
+        participants = pd.read_csv(participants_file, sep="\t", dtype=str)
+        if "lab" in participants.keys():
+            labs = dict(zip(participants["participant_id"], participants["lab"]))
+    label_labs = table["participant_id"].str.removeprefix("sub-").str[:3]
+    table["lab"] = table["participant_id"].map(labs).fillna(label_labs).astype(object)
+
+    required = [k for k, v in template.items() if v == "REQUIRED"]
+    missing = table.reindex(columns=required)
+    missing = missing.isna() | missing.eq("REQUIRED")
+
+    extra = [k for k in table.keys() if k not in template and k not in meta + ["lab"]]
+    extra = table[extra].notna()
+
+    fields = [k for k in consistent_fields if k in table.keys()]
+    inconsistent = pd.DataFrame(
+        {k: _lab_mode_mismatch(table, k) for k in fields}, index=table.index
+    )
+
+    def _flagged(mask):
+        columns = np.asarray(mask.columns, dtype=object)
+        flagged = [list(columns[row]) for row in mask.to_numpy(dtype=bool)]
+        return pd.Series(flagged, index=mask.index, dtype=object)
+
+    report = table[meta + ["lab"]].copy()
+    report["missing_required"] = _flagged(missing)
+    report["not_in_template"] = _flagged(extra)
+    report["inconsistent"] = _flagged(inconsistent)
+    report["ok"] = ~(
+        missing.any(axis=1).to_numpy()
+        | extra.any(axis=1).to_numpy()
+        | inconsistent.any(axis=1).to_numpy()
+    )
+    if verbose:
+        print(
+            f"{(~report.ok).sum()} of {len(report)} eeg sidecars flagged: "
+            f"{missing.any(axis=1).sum()} with missing REQUIRED fields, "
+            f"{extra.any(axis=1).sum()} with fields not in template, "
+            f"{inconsistent.any(axis=1).sum()} inconsistent within their lab"
+        )
+    return report
@@ -11,62 +11,149 @@ d.welke@leeds.ac.uk
 https://github.com/dominikwelke
 """
 
+import os
 import json
-import pandas as pd
+import shutil
+import tempfile
 
 from pathlib import Path
 from datetime import datetime
+from functools import lru_cache
+
+from .bids_trace import traced, count
 
 # further variables
 cwd = Path(__file__).parents[0]
-with (cwd / "bids_template.json").open("r") as f:
-    BIDS_template = json.load(f)
-
-BIDS_license = (Path(__file__).parents[0] / "bids_license.txt").resolve()
-
-
-# init def
-def init_folder(BIDS_root):
-    # BIDS_version = "1.9.0"
+BIDS_license = (cwd / "bids_license.txt").resolve()
 
-    # make BIDS directory
-    try:
-        BIDS_root.mkdir(parents=True)
-    except FileExistsError:
-        raise FileExistsError(
-            f"Folder {BIDS_root} already exists! check what you're doing"
-        )
 
-    # init README file
-    with (BIDS_root / "README").open("w+") as f:
-        f.write("")
+# resources are read on first use and cached
+@lru_cache(maxsize=None)
+def read_resource(name):
+    return (cwd / name).read_text()
 
-    # init CHANGES file
-    date = datetime.now().strftime("%Y-%m-%d")
-    with (BIDS_root / "CHANGES").open("w+") as f:
-        f.write(f"0.0.0\t{date}\n\t- Initial setup.")
 
-    # init LICENSE file
-    with (BIDS_root / "LICENSE").open("w+") as f:
-        f.write(BIDS_license.read_text())  # for text files
+@lru_cache(maxsize=None)
+def get_template():
+    return json.loads(read_resource("bids_template.json"))
 
-    # init dataset_description.json
-    with (BIDS_root / "dataset_description.json").open("w+") as f:
-        # json.dump(dataset_description,f,indent=4)
-        json.dump(BIDS_template["dataset_description"], f, indent=4)
 
-    # init participants.json
-    with (BIDS_root / "participants.json").open("w+") as f:
-        json.dump(BIDS_template["participants_json"], f, indent=4)
+def __getattr__(name):
+    # BIDS_template used to be loaded at import time
+    if name == "BIDS_template":
+        return get_template()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    # init participants.tsv
-    participants_tsv = {"participant_id": []}
-    for k in BIDS_template["participants_json"].keys():
-        participants_tsv[k] = []
 
-    pd.DataFrame(participants_tsv).to_csv(
-        BIDS_root / "participants.tsv", sep="\t", index=False
+# init def
+def render_folder(overrides=None):
+    """
+    contents of a new BIDS folder as {relative file name: text}.
+    overrides are merged into dataset_description.json (e.g. Name, Authors).
+    """
+    # BIDS_version = "1.9.0"
+    BIDS_template = get_template()
+    date = datetime.now().strftime("%Y-%m-%d")
+    dataset_description = dict(BIDS_template["dataset_description"])
+    dataset_description.update(overrides or {})
+    participants_tsv = dict.fromkeys(
+        ["participant_id", *BIDS_template["participants_json"]]
     )
-
-    # init folder structure
-    (BIDS_root / "phenotype").mkdir()
+    return {
+        "README": "",
+        "CHANGES": f"0.0.0\t{date}\n\t- Initial setup.",
+        "LICENSE": read_resource("bids_license.txt"),
+        "dataset_description.json": json.dumps(dataset_description, indent=4),
+        "participants.json": json.dumps(BIDS_template["participants_json"], indent=4),
+        "participants.tsv": "\t".join(participants_tsv) + "\n",
+    }
+
+
+def _write_folder(BIDS_root, files):
+    """
+    write files (see render_folder) and an empty phenotype folder to a temp
+    folder next to BIDS_root, then rename it into place. BIDS_root is never
+    visible half-built, and an existing folder is never touched.
+    """
+    BIDS_root = Path(BIDS_root)
+    if BIDS_root.exists():
+        raise FileExistsError(
+            f"Folder {BIDS_root} already exists! check what you're doing"
+        )
+    BIDS_root.parent.mkdir(parents=True, exist_ok=True)
+    tmp_root = Path(
+        tempfile.mkdtemp(dir=BIDS_root.parent, prefix=f".{BIDS_root.name}.")
+    )
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_root, 0o777 & ~umask)
+        for name, text in files.items():
+            (tmp_root / name).write_text(text)
+        (tmp_root / "phenotype").mkdir()
+        try:
+            os.rename(tmp_root, BIDS_root)
+        except OSError:
+            # another process created BIDS_root in the meantime
+            raise FileExistsError(
+                f"Folder {BIDS_root} already exists! check what you're doing"
+            ) from None
+    except BaseException:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        raise
+    return BIDS_root
+
+
+@traced
+def init_folder(BIDS_root, overrides=None):
+    """
+    create a new BIDS folder with README, CHANGES, LICENSE,
+    dataset_description.json, participants.json/.tsv and phenotype/.
+    raises FileExistsError if BIDS_root exists.
+    """
+    _write_folder(BIDS_root, render_folder(overrides))
+
+
+@traced
+def init_folders(roots, overrides_per_lab=None, n_jobs=None):
+    """
+    create several BIDS folders in parallel (thread pool with n_jobs workers).
+
+    roots maps lab names to BIDS roots, or is a list of roots whose lab is
+    their folder name (so a lab and its staging copy, e.g. /a/lab1 and
+    /b/lab1, are both created with the overrides of lab1).
+    overrides_per_lab maps lab names to dataset_description.json fields.
+    the template is rendered once; every folder is built in a temp folder and
+    renamed into place (see init_folder). all folders are attempted; the
+    first error is raised afterwards. the same root given twice raises
+    ValueError.
+    returns the list of created roots.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(roots, dict):
+        roots = list(roots.items())
+    else:
+        roots = [(Path(root).name, root) for root in roots]
+    paths = [os.path.abspath(root) for _, root in roots]
+    duplicates = sorted({p for p in paths if paths.count(p) > 1})
+    if duplicates:
+        raise ValueError(f"BIDS root(s) given more than once: {duplicates}")
+    overrides_per_lab = overrides_per_lab or {}
+
+    base = render_folder()
+    description = json.loads(base["dataset_description.json"])
+    files = {}
+    for lab, _ in roots:
+        files[lab] = base
+        if lab in overrides_per_lab:
+            files[lab] = dict(base)
+            files[lab]["dataset_description.json"] = json.dumps(
+                dict(description, **overrides_per_lab[lab]), indent=4
+            )
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_write_folder, root, files[lab]) for lab, root in roots]
+    created = [future.result() for future in futures]
+    count(files_written=len(created) * len(base))
+    return created
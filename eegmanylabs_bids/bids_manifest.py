@@ -0,0 +1,160 @@
+"""
+persistent file index of a BIDS folder (derivatives/manifest.json).
+lists every file with size, mtime and optional checksum, plus the subject,
+session and task it belongs to. updates only re-list directories whose mtime
+changed, so unchanged parts of the tree cost one stat per directory.
+
+note: directory mtimes change when files are added, removed or renamed (e.g.
+writes via temp file + rename, see bids_utils.atomic_write), but not when a
+file is modified in place. this package appends to derivatives/changes.jsonl
+and score_to_tsv appends to its output in place. update(checksum=True)
+re-stats every file, so such edits get a fresh checksum; otherwise use
+update(full=True) after them.
+"""
+
+import os
+import re
+import json
+import hashlib
+import pandas as pd
+
+from pathlib import Path
+
+from .bids_utils import atomic_write
+from .bids_trace import traced, count
+
+manifest_version = 1
+
+
+def _checksum(file):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _entity(name, path):
+    match = re.search(rf"(?:^|[/_]){name}-([a-zA-Z0-9]+)", path)
+    return match.group(1) if match else None
+
+
+class BIDSManifest:
+    """
+    file index of a BIDS folder, loaded from derivatives/manifest.json if it
+    exists. call update() to bring it up to date with the file system.
+    """
+
+    def __init__(self, BIDS_root):
+        self.BIDS_root = Path(BIDS_root)
+        self.manifest_file = self.BIDS_root / "derivatives" / "manifest.json"
+        self.dirs = {}
+        self.files = {}
+        if self.manifest_file.is_file():
+            manifest = json.loads(self.manifest_file.read_text())
+            if manifest.get("version") == manifest_version:
+                self.dirs = manifest["dirs"]
+                self.files = manifest["files"]
+
+    def _stat_file(self, path, file, checksum):
+        stat = os.stat(path)
+        old = self.files.get(file)
+        digest = None
+        if old is not None and old[:2] == [stat.st_size, stat.st_mtime_ns]:
+            digest = old[2]
+        if checksum and digest is None:
+            digest = _checksum(path)
+        return [stat.st_size, stat.st_mtime_ns, digest]
+
+    @traced
+    def update(self, checksum=False, full=False):
+        """
+        re-list directories whose mtime changed (all with full=True) and save.
+        with checksum=True, every listed file is re-stat'ed (also in unchanged
+        directories) and sha256 sums are computed for new/changed files.
+        """
+        manifest_rel = "/" + self.manifest_file.relative_to(self.BIDS_root).as_posix()
+        dirs, files = {}, {}
+        stack = [""]
+        while stack:
+            folder = stack.pop()
+            path = str(self.BIDS_root) + folder
+            mtime = os.stat(path).st_mtime_ns
+            known = self.dirs.get(folder)
+            if not full and known is not None and known["mtime"] == mtime:
+                dirs[folder] = known
+                for name in known["files"]:
+                    file = f"{folder}/{name}"
+                    entry = self.files[file]
+                    if checksum:
+                        # catches files modified in place, see module note
+                        entry = self._stat_file(f"{path}/{name}", file, checksum)
+                    files[file] = entry
+                stack.extend(f"{folder}/{d}" for d in known["subdirs"])
+                continue
+
+            subdirs, names = [], []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    file = f"{folder}/{entry.name}"
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif (
+                        entry.is_file()
+                        and entry.name != ".DS_Store"
+                        and file != manifest_rel
+                    ):
+                        names.append(entry.name)
+                        files[file] = self._stat_file(entry.path, file, checksum)
+            dirs[folder] = {"mtime": mtime, "subdirs": subdirs, "files": names}
+            stack.extend(f"{folder}/{d}" for d in subdirs)
+
+        count(dirs=len(dirs), files=len(files))
+        self.dirs, self.files = dirs, files
+        self.save()
+        return self
+
+    def save(self):
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        manifest = {"version": manifest_version, "dirs": self.dirs, "files": self.files}
+        atomic_write(
+            self.manifest_file, lambda tmp: tmp.write_text(json.dumps(manifest))
+        )
+
+    # queries
+    def file_list(self):
+        """
+        all files as sorted BIDS-relative paths ('/sub-01/eeg/...')
+        """
+        return sorted(self.files)
+
+    def subjects(self):
+        """
+        names of the sub-* folders
+        """
+        root = self.dirs.get("", {"subdirs": []})
+        return sorted(d for d in root["subdirs"] if d.startswith("sub-"))
+
+    def table(self):
+        """
+        one row per file: path, subject, session, task, size, mtime, checksum
+        """
+        paths = self.file_list()
+        entries = [self.files[p] for p in paths]
+        return pd.DataFrame(
+            {
+                "path": paths,
+                "subject": [_entity("sub", p) for p in paths],
+                "session": [_entity("ses", p) for p in paths],
+                "task": [_entity("task", p) for p in paths],
+                "size": [e[0] for e in entries],
+                "mtime": pd.to_datetime([e[1] for e in entries], unit="ns"),
+                "checksum": [e[2] for e in entries],
+            }
+        )
+
+    def sessions(self):
+        return sorted(set(self.table().session.dropna()))
+
+    def tasks(self):
+        return sorted(set(self.table().task.dropna()))
@@ -14,6 +14,8 @@ https://github.com/dominikwelke
 import pandas as pd
 import numpy as np
 
+from .bids_trace import traced, count, annotate
+
 pheno_dtypes = {
     "bfi_s": {
         k: "Int64" for k in ["bfi_ext", "bfi_agr", "bfi_con", "bfi_neg", "bfi_ope"]
@@ -28,187 +30,501 @@ pheno_dtypes = {
     "stai_t": {k: "Int64" for k in ["stai_t_state", "stai_t_trait"]},
 }
 
+# questionnaires (see scoring_specs) scored into each phenotype file
+pheno_questionnaires = {
+    "bfi_s": ["bfi_s15"],
+    "bisbas": ["bisbas"],
+    "ces": ["cesd"],
+    "ehi": ["ehi"],
+    "kss": ["kss"],
+    "panas_state": ["panas_state"],
+    "stai_t": ["stai_state", "stai_trait"],
+}
+
+
+def _items(prefix, n_items):
+    return [f"{prefix}{i}" for i in range(1, n_items + 1)]
+
+
+# bump when scoring logic changes in a way the specs below do not capture;
+# cached scores (see bids_build) are invalidated by this and by any spec edit
+scoring_spec_version = 2
+
+# scoring specs
+# each (questionnaire, order) pair maps to
+#   items:     raw item columns, in order
+#   range:     valid [min, max] item values
+#   center:    items are centered on this value before summation, missing items
+#              then count as the center value if skipna=True
+#              (with min_items, they count as the mean of the present items)
+#   reverse:   reverse coded items (1-based), scored as (min + max) - x
+#   subscales: items (1-based) summed into each output column
+scoring_specs = {
+    ("kss", None): {
+        "items": ["KSS"],
+        "range": (1, 9),
+        "center": 0,
+        "reverse": [],
+        "subscales": {"kss": [1]},
+    },
+    ("cesd", None): {
+        "items": _items("CESD_", 20),
+        "range": (0, 3),
+        "center": 0,
+        "reverse": [],
+        "subscales": {"ces_d": list(range(1, 21))},
+    },
+    ("bisbas", "general"): {
+        # see https://scales.arabpsychology.com/s/behavioral-avoidance-inhibition-scales-bis-bas/
+        "items": _items("BISBAS_", 24),
+        "range": (1, 4),
+        "center": 0,
+        "reverse": [i for i in range(1, 25) if i not in [2, 22]],
+        "subscales": {
+            "bis": [2, 8, 13, 16, 19, 22, 24],
+            "bas_drive": [3, 9, 12, 21],
+            "bas_funseek": [5, 10, 15, 20],
+            "bas_rewardresponse": [4, 7, 14, 18, 23],
+            # filler items [1, 6, 11, 17] not needed
+        },
+    },
+    ("bisbas", "en-2"): {
+        # see https://arc.psych.wisc.edu/self-report/behavioral-activation-and-behavioral-inhibition-scales-bai/
+        "items": _items("BISBAS_", 24),
+        "range": (1, 4),
+        "center": 0,
+        "reverse": [i for i in range(1, 25) if i not in [2, 22]],
+        "subscales": {
+            "bis": [1, 6, 10, 13, 15, 18, 20],
+            "bas_drive": [4, 8, 12, 16],
+            "bas_funseek": [2, 7, 9, 17],
+            "bas_rewardresponse": [3, 5, 11, 14, 19],
+        },
+    },
+    ("ehi", None): {
+        "items": _items("EHI_L_", 10) + _items("EHI_R_", 10),
+        "range": (0, 2),
+        "center": 0,
+        "reverse": [],
+        "subscales": {"left": list(range(1, 11)), "right": list(range(11, 21))},
+    },
+    ("bfi_s15", ""): {
+        "items": _items("BFI_", 15),
+        "range": (1, 7),
+        "center": 4,
+        "reverse": [1, 3, 7, 8, 10, 14],
+        "subscales": {
+            "bfi_ext": [1, 6, 11],
+            "bfi_agr": [2, 7, 12],
+            "bfi_con": [3, 8, 13],
+            "bfi_neg": [4, 9, 14],
+            "bfi_ope": [5, 10, 15],
+        },
+    },
+    ("bfi_s15", "ger-1"): {
+        # german version
+        # see https://zis.gesis.org/skala/Schupp-Gerlitz-Big-Five-Inventory-SOEP-(BFI-S)#
+        "items": _items("BFI_", 15),
+        "range": (1, 7),
+        "center": 4,
+        "reverse": [3, 6, 8, 15],
+        "subscales": {
+            "bfi_ext": [2, 6, 9],
+            "bfi_agr": [3, 7, 13],
+            "bfi_con": [1, 8, 12],
+            "bfi_neg": [5, 11, 15],
+            "bfi_ope": [4, 10, 14],
+        },
+    },
+    ("bfi_s15", "en-1"): {
+        # english version
+        # see https://www.oecd.org/skills/piaac/Annex-A-Measures-of-the-big-five-dimensions.pdf
+        "items": _items("BFI_", 15),
+        "range": (1, 7),
+        "center": 4,
+        "reverse": [3, 6, 10, 14],
+        "subscales": {
+            "bfi_ext": [4, 5, 6],
+            "bfi_agr": [10, 11, 12],
+            "bfi_con": [13, 14, 15],
+            "bfi_neg": [1, 2, 3],
+            "bfi_ope": [7, 8, 9],
+        },
+    },
+    ("panas_state", "en-1"): {
+        # see https://ogg.osu.edu/media/documents/MB%20Stream/PANAS.pdf
+        "items": _items("PANAS_S_", 20),
+        "range": (1, 5),
+        "center": 0,
+        "reverse": [],
+        "subscales": {
+            "panas_s_NA": [2, 4, 6, 7, 8, 11, 13, 15, 18, 20],
+            "panas_s_PA": [1, 3, 5, 9, 10, 12, 14, 16, 17, 19],
+        },
+    },
+    ("panas_state", "ger-1"): {
+        "items": _items("PANAS_S_", 20),
+        "range": (1, 5),
+        "center": 0,
+        "reverse": [],
+        "subscales": {
+            "panas_s_NA": [2, 5, 7, 8, 9, 12, 14, 16, 19, 20],
+            "panas_s_PA": [1, 3, 4, 6, 10, 11, 13, 15, 17, 18],
+        },
+    },
+    ("stai_state", "ger-1"): {
+        # verified for TUD/UHH
+        "items": _items("STAI_S_", 20),
+        "range": (1, 4),
+        "center": 2.5,
+        "reverse": [1, 2, 5, 8, 10, 11, 15, 16, 19, 20],
+        "subscales": {"stai_t_state": list(range(1, 21))},
+    },
+    ("stai_state", "en-1"): {
+        # see https://arc.psych.wisc.edu/self-report/state-trait-anxiety-inventory-sta/
+        "items": _items("STAI_S_", 20),
+        "range": (1, 4),
+        "center": 2.5,
+        "reverse": [1, 2, 5, 8, 10, 11, 15, 16, 19, 20],
+        "subscales": {"stai_t_state": list(range(1, 21))},
+    },
+    ("stai_trait", "ger-1"): {
+        "items": _items("STAI_T_", 20),
+        "range": (1, 4),
+        "center": 2.5,
+        "reverse": [1, 6, 7, 10, 13, 16, 19],
+        "subscales": {"stai_t_trait": list(range(1, 21))},
+    },
+    ("stai_trait", "en-1"): {
+        # see https://arc.psych.wisc.edu/self-report/state-trait-anxiety-inventory-sta/
+        "items": _items("STAI_T_", 20),
+        "range": (1, 4),
+        "center": 2.5,
+        "reverse": [1, 3, 6, 7, 10, 13, 14, 16, 19],
+        "subscales": {"stai_t_trait": list(range(1, 21))},
+    },
+}
+
+
+def _compile_spec(spec):
+    """
+    turn a scoring spec into arrays for the scoring engine:
+    per-item sign and shift (centering + reverse coding), the item x subscale
+    weight matrix and the per-subscale offset that undoes the centering
+    """
+    n_items = len(spec["items"])
+    low, high = spec["range"]
+    reverse = np.zeros(n_items, dtype=bool)
+    reverse[[i - 1 for i in spec["reverse"]]] = True
+    sign = np.where(reverse, -1.0, 1.0)
+    shift = np.where(reverse, low + high, 0.0) - spec["center"]
+    weights = np.zeros((n_items, len(spec["subscales"])))
+    for j, subscale_items in enumerate(spec["subscales"].values()):
+        weights[[i - 1 for i in subscale_items], j] = 1.0
+    offset = spec["center"] * weights.sum(axis=0)
+    return sign, shift, weights, offset
+
+
+def _min_present(min_items, n_items):
+    """
+    minimum number of present items per subscale for prorated scoring.
+    min_items is a count (capped at the subscale length) or a float in (0, 1],
+    the fraction of the subscale's items.
+    """
+    n_items = np.asarray(n_items, dtype=np.float64)
+    if isinstance(min_items, float):
+        if not 0.0 < min_items <= 1.0:
+            raise ValueError(f"min_items fraction must be in (0, 1], got {min_items}")
+        return np.ceil(np.round(min_items * n_items, 9))
+    if min_items < 1:
+        raise ValueError(f"min_items must be at least 1, got {min_items}")
+    return np.minimum(min_items, n_items)
+
+
+def _coerce_items(data_in, keys):
+    """
+    coerce item columns to a contiguous float array.
+    numeric columns are copied as one block, only the remaining (object/string)
+    columns are parsed; non-numeric entries become nan
+    """
+    data = data_in[keys]
+    numeric = np.array(
+        [pd.api.types.is_numeric_dtype(dtype) for dtype in data.dtypes], dtype=bool
+    )
+    items = np.empty(data.shape, dtype=np.float64)
+    if numeric.any():
+        items[:, numeric] = data.loc[:, numeric].to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+    for i in np.flatnonzero(~numeric):
+        items[:, i] = pd.to_numeric(data.iloc[:, i], errors="coerce").to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+    return items
+
+
+def _range_errors(items, index, keys, low, high):
+    """
+    describe every cell outside [low, high]
+    """
+    low = np.broadcast_to(low, len(keys))
+    high = np.broadcast_to(high, len(keys))
+    with np.errstate(invalid="ignore"):
+        bad = (items < low) | (items > high)
+    rows, cols = np.nonzero(bad)
+    return [
+        f"  row {index[r]!r}, column '{keys[c]}': {items[r, c]:g} "
+        f"(valid [{low[c]:g}, {high[c]:g}])"
+        for r, c in zip(rows, cols)
+    ]
+
+
+def _raise_range_errors(cells):
+    if cells:
+        raise ValueError(
+            f"{len(cells)} questionnaire value(s) out of range:\n" + "\n".join(cells)
+        )
+
+
+def _check_item_ranges(items, index, keys, low, high):
+    """
+    raise ValueError listing every cell outside [low, high]
+    """
+    _raise_range_errors(_range_errors(items, index, keys, low, high))
+
+
+def _coerce_items_lean(data_in, keys, low, high):
+    """
+    coerce item columns straight into a column-major int8 array plus a
+    missing mask, one column at a time (missing items are stored as 0).
+    raises ValueError listing every out-of-range or non-integer cell.
+    """
+    items = np.zeros((len(data_in), len(keys)), dtype=np.int8, order="F")
+    missing = np.zeros(items.shape, dtype=bool, order="F")
+    cells = []
+    for j, k in enumerate(keys):
+        column = pd.to_numeric(data_in[k], errors="coerce").to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        cells += _range_errors(column[:, None], data_in.index, [k], low, high)
+        missing[:, j] = np.isnan(column)
+        fractional = np.flatnonzero((column != np.round(column)) & ~missing[:, j])
+        cells += [
+            f"  row {data_in.index[r]!r}, column '{k}': {column[r]:g} (not an integer)"
+            for r in fractional
+        ]
+        np.copyto(items[:, j], column, casting="unsafe", where=~missing[:, j])
+    _raise_range_errors(cells)
+    return items, missing
+
+
+def _score_lean(items, missing, spec, skipna, min_items=None):
+    """
+    integer scoring: reverse code in place as (min + max) - x and sum each
+    subscale into a nullable Int64 column (float64 if prorated).
+    with skipna, missing items count as the center value; sums are taken in
+    half units so a center of e.g. 2.5 stays exact, and subscales with a
+    half-integer score become a nullable Float64 column.
+    """
+    low, high = spec["range"]
+    center2 = int(round(2 * spec["center"]))
+    assert center2 == 2 * spec["center"], "lean scoring needs a center in halves"
+    for i in spec["reverse"]:
+        np.subtract(
+            low + high, items[:, i - 1], out=items[:, i - 1], where=~missing[:, i - 1]
+        )
+    scores = {}
+    for name, subscale_items in spec["subscales"].items():
+        idx = [i - 1 for i in subscale_items]
+        total = items[:, idx].sum(axis=1, dtype=np.int64)
+        if min_items is not None:
+            n_present = len(idx) - missing[:, idx].sum(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                prorated = total * (len(idx) / n_present)
+            prorated[n_present < _min_present(min_items, len(idx))] = np.nan
+            scores[name] = prorated
+            continue
+        if not skipna:
+            scores[name] = pd.arrays.IntegerArray(total, missing[:, idx].any(axis=1))
+            continue
+        na = np.zeros(len(total), dtype=bool)
+        total2 = 2 * total + center2 * missing[:, idx].sum(axis=1, dtype=np.int64)
+        if (total2 % 2 == 0).all():
+            scores[name] = pd.arrays.IntegerArray(total2 // 2, na)
+        else:
+            scores[name] = pd.arrays.FloatingArray(total2 / 2, na)
+    return scores
+
+
+@traced
+def validate_questionnaires(data_in):
+    """
+    coerce and range-check the items of every questionnaire in scoring_specs
+    that is fully present in data_in, in a single scan.
+    returns a copy of data_in with those columns converted to float.
+    raises ValueError listing every out-of-range cell with its row and column.
+    """
+    ranges = {}
+    for spec in scoring_specs.values():
+        if all(k in data_in.keys() for k in spec["items"]):
+            ranges.update({k: spec["range"] for k in spec["items"]})
+    keys = list(ranges)
+    data_out = data_in.copy()
+    if not keys:
+        return data_out
+
+    items = _coerce_items(data_in, keys)
+    low, high = np.array([ranges[k] for k in keys], dtype=np.float64).T
+    _check_item_ranges(items, data_in.index, keys, low, high)
+    data_out[keys] = pd.DataFrame(items, index=data_in.index, columns=keys)
+    return data_out
+
+
+@traced
+def score_questionnaire(
+    data_in, questionnaire, order=None, skipna=False, lean=False, min_items=None
+):
+    """
+    score all subscales of a questionnaire as defined in scoring_specs.
+    returns a DataFrame with one column per subscale, indexed like data_in.
+    raises ValueError listing every item value outside the valid range.
+
+    with min_items, subscales are prorated instead (skipna is ignored): the
+    mean of the present items times the number of items, if at least
+    min_items items are present, nan otherwise. min_items is a count or a
+    float in (0, 1], the fraction of the subscale's items. prorated scores
+    are not rounded.
+
+    with lean=True, items are stored as int8, reverse coded in place with
+    integer arithmetic and summed into exact nullable Int64 scores. items must
+    then be integers. with skipna=True, missing items count as the center
+    value as in the default float scoring; subscales with a half-integer
+    score (center 2.5) are returned as nullable Float64.
+    """
+    if (questionnaire, order) not in scoring_specs:
+        raise NotImplementedError(
+            f"no scoring spec for questionnaire '{questionnaire}', order '{order}'"
+        )
+    spec = scoring_specs[(questionnaire, order)]
+    annotate(questionnaire=questionnaire, order=order, lean=lean, min_items=min_items)
+    count(rows=len(data_in), items=len(spec["items"]))
+
+    # check input
+    keys = spec["items"]
+    assert sum([k in data_in.keys() for k in keys]) == len(keys)
+    low, high = spec["range"]
+    if lean:
+        items, missing = _coerce_items_lean(data_in, keys, low, high)
+        scores = _score_lean(items, missing, spec, skipna, min_items)
+        return pd.DataFrame(scores, index=data_in.index)
+    items = _coerce_items(data_in, keys)
+    _check_item_ranges(items, data_in.index, keys, low, high)
+
+    # transcribe
+    sign, shift, weights, offset = _compile_spec(spec)
+    missing = np.isnan(items)
+    centered = items * sign + shift
+    centered[missing] = 0.0
+    scores = centered @ weights + offset
+    if min_items is not None:
+        # mean of the present items per subscale, scaled to the item count
+        n_items = weights.sum(axis=0)
+        n_present = n_items - missing @ weights
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (centered @ weights / n_present + spec["center"]) * n_items
+        scores[n_present < _min_present(min_items, n_items)] = np.nan
+    elif not skipna:
+        scores[(missing @ weights) > 0] = np.nan
+
+    return pd.DataFrame(scores, index=data_in.index, columns=list(spec["subscales"]))
+
 
 # questionnaire parser defs
+@traced
 def parse_kss(data_in):
     """
     requires column named 'KSS'
     values in range [1,9] or nan
     """
-    # check input
-    assert "KSS" in data_in.keys()
-    KSS_data = data_in["KSS"].apply(pd.to_numeric, errors="coerce")
-    if not sum(KSS_data.isnull()) == len(KSS_data):
-        assert KSS_data.min(axis=None, skipna=True) >= 1
-        assert KSS_data.max(axis=None, skipna=True) <= 9
-
-    # transcribe
-    return KSS_data
+    return score_questionnaire(data_in, "kss")["kss"].rename("KSS")
 
 
-def parse_cesd(data_in, skipna=False):
+@traced
+def parse_cesd(data_in, skipna=False, min_items=None):
     """
     requires columns named 'CESD_[1-20]'
     values in range [0,3] or nan
     """
-    # check input
-    CES_keys = [f"CESD_{i}" for i in range(1, 21)]
-    assert sum([k in data_in.keys() for k in CES_keys]) == 20
-    CES_data = data_in[CES_keys].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(CES_data.min(axis=None, skipna=True)):
-        assert CES_data.min(axis=None, skipna=True) >= 0
-        assert CES_data.max(axis=None, skipna=True) <= 3
-
-    # transcribe
-    CES = CES_data.sum(axis=1, skipna=skipna)
-    return CES
+    scores = score_questionnaire(data_in, "cesd", skipna=skipna, min_items=min_items)
+    return scores["ces_d"].rename(None)
 
 
-def parse_bisbas(data_in, order=None, skipna=False):
+@traced
+def parse_bisbas(data_in, order=None, skipna=False, min_items=None):
     """
     requires columns named 'BISBAS_[1-24]'
     values in range [1,4] or nan
     """
-    # check input
-    BISBAS_keys = [f"BISBAS_{i}" for i in range(1, 25)]
-    assert sum([k in data_in.keys() for k in BISBAS_keys]) == 24
-    BISBAS_data = data_in[BISBAS_keys].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(BISBAS_data.min(axis=None, skipna=True)):
-        assert BISBAS_data.min(axis=None, skipna=True) >= 1
-        assert BISBAS_data.max(axis=None, skipna=True) <= 4
+    return score_questionnaire(
+        data_in, "bisbas", order=order, skipna=skipna, min_items=min_items
+    )
 
-    # transcribe
-    # reverse code all but 2 items
-    reverse_keys = [f"BISBAS_{i}" for i in range(1, 25) if i not in [2, 22]]
-    BISBAS_data[reverse_keys] = BISBAS_data[reverse_keys] * -1 + 5
 
-    # compute subscores
-    if order == "general":
-        # see https://scales.arabpsychology.com/s/behavioral-avoidance-inhibition-scales-bis-bas/
-        BIS_keys = [f"BISBAS_{k}" for k in [2, 8, 13, 16, 19, 22, 24]]
-        BAS_dri_keys = [f"BISBAS_{k}" for k in [3, 9, 12, 21]]
-        BAS_fun_keys = [f"BISBAS_{k}" for k in [5, 10, 15, 20]]
-        BAS_rew_keys = [f"BISBAS_{k}" for k in [4, 7, 14, 18, 23]]
-        # filler_keys = [f"BISBAS_{k}" for k in [1, 6, 11, 17]]  # not needed
-    elif order == "en-2":
-        # see https://arc.psych.wisc.edu/self-report/behavioral-activation-and-behavioral-inhibition-scales-bai/
-        BIS_keys = [f"BISBAS_{k}" for k in [1, 6, 10, 13, 15, 18, 20]]
-        BAS_dri_keys = [f"BISBAS_{k}" for k in [4, 8, 12, 16]]
-        BAS_fun_keys = [f"BISBAS_{k}" for k in [2, 7, 9, 17]]
-        BAS_rew_keys = [f"BISBAS_{k}" for k in [3, 5, 11, 14, 19]]
-        # filler_keys = [f"BISBAS_{k}" for k in [1, 6, 11, 17]]  # not needed
-
-    else:
-        raise NotImplementedError
-
-    BISBAS = pd.DataFrame(
-        {
-            "bis": BISBAS_data[BIS_keys].sum(axis=1, skipna=skipna),
-            "bas_drive": BISBAS_data[BAS_dri_keys].sum(axis=1, skipna=skipna),
-            "bas_funseek": BISBAS_data[BAS_fun_keys].sum(axis=1, skipna=skipna),
-            "bas_rewardresponse": BISBAS_data[BAS_rew_keys].sum(axis=1, skipna=skipna),
-        }
+@traced
+def classify_handedness(lq, thresholds=(-40.0, 40.0)):
+    """
+    bin laterality quotients into 'l' (lq <= lower), 'r' (lq >= upper) and
+    'a' (ambidextrous, in between). nan stays missing.
+    returns a categorical Series indexed like lq.
+    """
+    lower, upper = thresholds
+    lq = pd.Series(lq, dtype=np.float64)
+    values = lq.to_numpy()
+    codes = np.select(
+        [np.isnan(values), values <= lower, values >= upper], [-1, 0, 2], default=1
     )
+    handedness = pd.Categorical.from_codes(codes, categories=["l", "a", "r"])
+    return pd.Series(handedness, index=lq.index)
 
-    return BISBAS
 
-
-def parse_ehi(data_in, skipna=True):
+@traced
+def parse_ehi(data_in, skipna=True, thresholds=(-40.0, 40.0), min_items=None):
     """
     requires columns named 'EHI_L_[1-10]' and 'EHI_R_[1-10]'
     data range [0-2] or nan
-    """
-    if not skipna:
-        raise NotImplementedError("Handling NaN not yet implemented")
-
-    # check input
-    EHI_keys_left = [f"EHI_L_{i}" for i in range(1, 11)]
-    EHI_keys_right = [f"EHI_R_{i}" for i in range(1, 11)]
-    assert sum([k in data_in.keys() for k in EHI_keys_left]) == 10
-    assert sum([k in data_in.keys() for k in EHI_keys_right]) == 10
-    left = data_in[EHI_keys_left].apply(pd.to_numeric, errors="coerce")
-    right = data_in[EHI_keys_right].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(left.min(axis=None, skipna=True)):
-        assert left.min(axis=None, skipna=True) >= 0
-        assert left.max(axis=None, skipna=True) <= 2
-    if not np.isnan(right.min(axis=None, skipna=True)):
-        assert right.min(axis=None, skipna=True) >= 0
-        assert right.max(axis=None, skipna=True) <= 2
 
+    with skipna=False, rows with any missing item get nan scores.
+    thresholds are the laterality quotients for left/right handedness.
+    min_items prorates the left/right sums (see score_questionnaire).
+    """
     # transcribe
-    left = left.sum(axis=1, skipna=skipna)
-    right = right.sum(axis=1, skipna=skipna)
+    sums = score_questionnaire(data_in, "ehi", skipna=skipna, min_items=min_items)
+    left = sums["left"]
+    right = sums["right"]
     lq = (
         (right - left) / (right + left) * 100.0
     )  # laterality quotient, as determined by EHI
-    handedness = lq.apply(
-        lambda x: x if pd.isna(x) else "r" if x >= 40.0 else "l" if x <= -40.0 else "a"
-    )
+    handedness = classify_handedness(lq, thresholds=thresholds)
 
     EHI = pd.DataFrame({"EHI_handedness": handedness, "EHI_LQ": lq})
 
     return EHI
 
 
-def parse_bfi_s15(data_in, order=None, skipna=False):
+@traced
+def parse_bfi_s15(data_in, order=None, skipna=False, min_items=None):
     """
     BFI-S 15 item version. 1-7 likert scale
     requires columns named 'BFI_[1-15]'
     data range [1-7] or nan
     """
-
-    # check input
-    BFI_keys = [f"BFI_{i}" for i in range(1, 16)]
-    assert sum([k in data_in.keys() for k in BFI_keys]) == 15
-
-    # transpose data if necessary
-    t = 4  # transpose [1,7] to [-3, 3] range
-    BFI_data = data_in[BFI_keys].apply(pd.to_numeric, errors="coerce") - t
-    if not np.isnan(BFI_data.min(axis=None, skipna=True)):
-        assert BFI_data.min(axis=None, skipna=True) >= -3
-        assert BFI_data.max(axis=None, skipna=True) <= 3
-
-    # transcribe
-    if order == "":
-        REV_keys = [f"BFI_{i}" for i in [1, 3, 7, 8, 10, 14]]
-        EXT_keys = [f"BFI_{i}" for i in [1, 6, 11]]
-        AGR_keys = [f"BFI_{i}" for i in [2, 7, 12]]
-        CON_keys = [f"BFI_{i}" for i in [3, 8, 13]]
-        NEG_keys = [f"BFI_{i}" for i in [4, 9, 14]]
-        OPE_keys = [f"BFI_{i}" for i in [5, 10, 15]]
-    elif order == "ger-1":
-        # german version
-        # see https://zis.gesis.org/skala/Schupp-Gerlitz-Big-Five-Inventory-SOEP-(BFI-S)#
-        REV_keys = [f"BFI_{i}" for i in [3, 6, 8, 15]]
-        EXT_keys = [f"BFI_{i}" for i in [2, 6, 9]]
-        AGR_keys = [f"BFI_{i}" for i in [3, 7, 13]]
-        CON_keys = [f"BFI_{i}" for i in [1, 8, 12]]
-        NEG_keys = [f"BFI_{i}" for i in [5, 11, 15]]
-        OPE_keys = [f"BFI_{i}" for i in [4, 10, 14]]
-    elif order == "en-1":
-        # english version
-        # see https://www.oecd.org/skills/piaac/Annex-A-Measures-of-the-big-five-dimensions.pdf
-        REV_keys = [f"BFI_{i}" for i in [3, 6, 10, 14]]
-        EXT_keys = [f"BFI_{i}" for i in [4, 5, 6]]
-        AGR_keys = [f"BFI_{i}" for i in [10, 11, 12]]
-        CON_keys = [f"BFI_{i}" for i in [13, 14, 15]]
-        NEG_keys = [f"BFI_{i}" for i in [1, 2, 3]]
-        OPE_keys = [f"BFI_{i}" for i in [7, 8, 9]]
-    else:
-        raise NotImplementedError
-
-    BFI_data.loc[:, REV_keys] *= -1
-    BFI_data["bfi_ext"] = BFI_data.loc[:, EXT_keys].sum(axis=1, skipna=skipna)
-    BFI_data["bfi_agr"] = BFI_data.loc[:, AGR_keys].sum(axis=1, skipna=skipna)
-    BFI_data["bfi_con"] = BFI_data.loc[:, CON_keys].sum(axis=1, skipna=skipna)
-    BFI_data["bfi_neg"] = BFI_data.loc[:, NEG_keys].sum(axis=1, skipna=skipna)
-    BFI_data["bfi_ope"] = BFI_data.loc[:, OPE_keys].sum(axis=1, skipna=skipna)
-
-    BFI = BFI_data[["bfi_ext", "bfi_agr", "bfi_con", "bfi_neg", "bfi_ope"]] + 3 * t
-    return BFI
+    return score_questionnaire(
+        data_in, "bfi_s15", order=order, skipna=skipna, min_items=min_items
+    )
 
 
-def parse_panas_state(data_in, order=None, skipna=False):
+@traced
+def parse_panas_state(data_in, order=None, skipna=False, min_items=None):
     """
     requires columns named 'PANAS_S_[1-20]'
     data range [1-5] or nan
@@ -217,95 +533,71 @@ def parse_panas_state(data_in, order=None, skipna=False):
     items [1,3,5,9,10,12,14,16,17,19] to PA subscale
     items [2,4,6,7,8,11,13,15,18,20] to NA subscale
     """
-
-    # check input
-    panas_keys = [f"PANAS_S_{i}" for i in range(1, 21)]
-    assert sum([k in data_in.keys() for k in panas_keys]) == 20
-    PANAS_S_data = data_in[panas_keys].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(PANAS_S_data.min(axis=None, skipna=True)):
-        assert PANAS_S_data.min(axis=None, skipna=True) >= 1
-        assert PANAS_S_data.max(axis=None, skipna=True) <= 5
-
-    # transcribe
-    if order == "en-1":
-        # see https://ogg.osu.edu/media/documents/MB%20Stream/PANAS.pdf
-        PA_keys = [f"PANAS_S_{i}" for i in [1, 3, 5, 9, 10, 12, 14, 16, 17, 19]]
-        NA_keys = [f"PANAS_S_{i}" for i in [2, 4, 6, 7, 8, 11, 13, 15, 18, 20]]
-    elif order == "ger-1":
-        PA_keys = [f"PANAS_S_{i}" for i in [1, 3, 4, 6, 10, 11, 13, 15, 17, 18]]
-        NA_keys = [f"PANAS_S_{i}" for i in [2, 5, 7, 8, 9, 12, 14, 16, 19, 20]]
-    else:
-        raise NotImplementedError
-
-    PANAS_S_data["panas_s_PA"] = PANAS_S_data[PA_keys].sum(axis=1, skipna=skipna)
-    PANAS_S_data["panas_s_NA"] = PANAS_S_data[NA_keys].sum(axis=1, skipna=skipna)
-
-    PANAS_S = PANAS_S_data[["panas_s_NA", "panas_s_PA"]]
-    return PANAS_S
+    return score_questionnaire(
+        data_in, "panas_state", order=order, skipna=skipna, min_items=min_items
+    )
 
 
-def parse_stai_state(data_in, order=None, skipna=False):
+@traced
+def parse_stai_state(data_in, order=None, skipna=False, min_items=None):
     """
     requires columns named 'STAI_S_[1-20]'
     data range [1-4] or nan
     """
-    # check input
-    stai_keys = [f"STAI_S_{i}" for i in range(1, 21)]
-    assert sum([k in data_in.keys() for k in stai_keys]) == 20
-    STAI_S_data = data_in[stai_keys].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(STAI_S_data.min(axis=None, skipna=True)):
-        assert STAI_S_data.min(axis=None, skipna=True) >= 1
-        assert STAI_S_data.max(axis=None, skipna=True) <= 4
-
-    # transpose to mirrored
-    t = 2.5
-    STAI_S_data.loc[:, stai_keys] -= t
-
-    # apply reverse coding
-    if order == "ger-1":
-        # verified for TUD/UHH
-        REV_keys = [f"STAI_S_{i}" for i in [1, 2, 5, 8, 10, 11, 15, 16, 19, 20]]
-    elif order == "en-1":
-        # see https://arc.psych.wisc.edu/self-report/state-trait-anxiety-inventory-sta/
-        REV_keys = [f"STAI_S_{i}" for i in [1, 2, 5, 8, 10, 11, 15, 16, 19, 20]]
-    else:
-        raise NotImplementedError
-    STAI_S_data.loc[:, REV_keys] *= -1
-
-    # transcribe
-    STAI_S = STAI_S_data.sum(axis=1, skipna=skipna) + 20 * t
-
-    return STAI_S
+    STAI_S = score_questionnaire(
+        data_in, "stai_state", order=order, skipna=skipna, min_items=min_items
+    )
+    return STAI_S["stai_t_state"].rename(None)
 
 
-def parse_stai_trait(data_in, order=None, skipna=False):
+@traced
+def parse_stai_trait(data_in, order=None, skipna=False, min_items=None):
     """
     requires columns named 'STAI_T_[1-20]'
     data range [1-4] or nan
     """
-    # check input
-    stai_keys = [f"STAI_T_{i}" for i in range(1, 21)]
-    assert sum([k in data_in.keys() for k in stai_keys]) == 20
-    STAI_T_data = data_in[stai_keys].apply(pd.to_numeric, errors="coerce")
-    if not np.isnan(STAI_T_data.min(axis=None, skipna=True)):
-        assert STAI_T_data.min(axis=None, skipna=True) >= 1
-        assert STAI_T_data.max(axis=None, skipna=True) <= 4
-
-    # transpose to mirrored
-    t = 2.5
-    STAI_T_data.loc[:, stai_keys] -= t
-
-    # apply reverse coding
-    if order == "ger-1":
-        REV_keys = [f"STAI_T_{i}" for i in [1, 6, 7, 10, 13, 16, 19]]
-    elif order == "en-1":
-        # see https://arc.psych.wisc.edu/self-report/state-trait-anxiety-inventory-sta/
-        REV_keys = [f"STAI_T_{i}" for i in [1, 3, 6, 7, 10, 13, 14, 16, 19]]
-    else:
-        raise NotImplementedError
-    STAI_T_data.loc[:, REV_keys] *= -1
+    STAI_T = score_questionnaire(
+        data_in, "stai_trait", order=order, skipna=skipna, min_items=min_items
+    )
+    return STAI_T["stai_t_trait"].rename(None)
 
-    # transcribe
-    STAI_T = STAI_T_data.sum(axis=1, skipna=skipna) + 20 * t
 
-    return STAI_T
+@traced
+def score_phenotype(data_in, orders=None, skipna=False, lean=False, min_items=None):
+    """
+    score every questionnaire whose items are all present in data_in.
+    orders maps questionnaire names to their item order,
+    e.g. {"bfi_s15": "ger-1", "bisbas": "general"}.
+    returns a dict {phenotype file name: DataFrame} indexed like data_in,
+    with the columns of the BIDS phenotype tables.
+    lean and min_items are passed to score_questionnaire (EHI is always
+    scored as float).
+    """
+    if orders is None:
+        orders = {}
+    phenotype = {}
+    for pheno_name, questionnaires in pheno_questionnaires.items():
+        scores = []
+        for questionnaire in questionnaires:
+            spec = next(
+                spec for (q, _), spec in scoring_specs.items() if q == questionnaire
+            )
+            if not all(k in data_in.keys() for k in spec["items"]):
+                continue
+            if questionnaire == "ehi":
+                EHI = parse_ehi(data_in, skipna=skipna, min_items=min_items)
+                scores.append(EHI.rename(columns=str.lower))
+            else:
+                scores.append(
+                    score_questionnaire(
+                        data_in,
+                        questionnaire,
+                        order=orders.get(questionnaire),
+                        skipna=skipna,
+                        lean=lean,
+                        min_items=min_items,
+                    )
+                )
+        if scores:
+            phenotype[pheno_name] = pd.concat(scores, axis=1)
+    return phenotype
@@ -0,0 +1,293 @@
+"""
+columnar (parquet / feather) mirror of participants.tsv and phenotype tables.
+the mirror lives in derivatives/columnar and is regenerated whenever one of the
+source TSVs changes; loading it avoids re-parsing the TSVs for every analysis.
+requires pyarrow.
+
+pooled_table / iter_pooled read participants and phenotype tables of many BIDS
+roots (e.g. one per lab) concurrently, with column and row filters.
+"""
+
+import os
+import json
+import glob
+import shutil
+import tempfile
+import pandas as pd
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .bids_utils import BIDSDataset
+from .bids_trace import traced, count
+from .bids_phenotype import pheno_dtypes
+
+columnar_formats = ["parquet", "feather"]
+
+
+def _columnar_folder(BIDS_root):
+    return BIDS_root / "derivatives" / "columnar"
+
+
+def _source_stamps(dataset):
+    """
+    size and mtime of participants.tsv and every phenotype table
+    """
+    stamps = {}
+    tsv_files = [dataset.BIDS_root / "participants.tsv"] + dataset.phenotype_files()
+    for tsv_file in tsv_files:
+        stat = tsv_file.stat()
+        stamps[str(tsv_file.relative_to(dataset.BIDS_root))] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+        ]
+    return stamps
+
+
+def _check_format(fmt):
+    if fmt not in columnar_formats:
+        raise ValueError(f"format must be one of {columnar_formats}, got '{fmt}'")
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("the columnar mirror requires pyarrow") from None
+
+
+@traced
+def write_columnar(BIDS_root, fmt="parquet"):
+    """
+    write participants.tsv and all phenotype tables to derivatives/columnar,
+    with the dtypes used for the TSVs (Int64 age, pheno_dtypes).
+    the mirror is built in a temp folder and swapped in, so files of tables
+    that no longer exist are removed with the old mirror.
+    """
+    _check_format(fmt)
+    BIDS_root = Path(BIDS_root)
+    folder = _columnar_folder(BIDS_root)
+    folder.parent.mkdir(parents=True, exist_ok=True)
+
+    dataset = BIDSDataset(BIDS_root)
+    stamps = _source_stamps(dataset)
+    tmp_folder = Path(tempfile.mkdtemp(dir=folder.parent, prefix=".columnar."))
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_folder, 0o777 & ~umask)
+        for tsv_file, tsv in dataset.tables().items():
+            name = tsv_file.with_suffix("").name
+            if tsv_file.parent.name == "phenotype":
+                name = f"phenotype_{name}"
+            if fmt == "parquet":
+                tsv.to_parquet(tmp_folder / f"{name}.parquet", index=False)
+            else:
+                tsv.to_feather(
+                    tmp_folder / f"{name}.feather", compression="uncompressed"
+                )
+        (tmp_folder / "sources.json").write_text(
+            json.dumps({"format": fmt, "sources": stamps})
+        )
+        old_folder = None
+        if folder.exists():
+            old_folder = Path(
+                tempfile.mkdtemp(dir=folder.parent, prefix=".columnar.old.")
+            )
+            os.replace(folder, old_folder / "columnar")
+        os.replace(tmp_folder, folder)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    if old_folder is not None:
+        shutil.rmtree(old_folder, ignore_errors=True)
+    count(
+        files_written=len(stamps), rows_written=sum(map(len, dataset.tables().values()))
+    )
+
+
+def is_columnar_stale(BIDS_root, fmt="parquet"):
+    """
+    True if the mirror is missing, in another format or older than the TSVs
+    """
+    BIDS_root = Path(BIDS_root)
+    stamp_file = _columnar_folder(BIDS_root) / "sources.json"
+    if not stamp_file.is_file():
+        return True
+    stamp = json.loads(stamp_file.read_text())
+    return stamp["format"] != fmt or stamp["sources"] != _source_stamps(
+        BIDSDataset(BIDS_root)
+    )
+
+
+def _read_columnar(file, memory_map):
+    if file.suffix == ".parquet":
+        return pd.read_parquet(file, memory_map=memory_map)
+    from pyarrow import feather
+
+    return feather.read_table(file, memory_map=memory_map).to_pandas()
+
+
+@traced
+def load_columnar(BIDS_root, fmt="parquet", memory_map=False):
+    """
+    participants joined with all phenotype tables (one row per participant),
+    read from the columnar mirror. the mirror is regenerated first if any
+    TSV changed since it was written.
+    """
+    _check_format(fmt)
+    BIDS_root = Path(BIDS_root)
+    if is_columnar_stale(BIDS_root, fmt):
+        write_columnar(BIDS_root, fmt)
+
+    folder = _columnar_folder(BIDS_root)
+    table = _read_columnar(folder / f"participants.{fmt}", memory_map)
+    for pheno_file in sorted(folder.glob(f"phenotype_*.{fmt}")):
+        pheno = _read_columnar(pheno_file, memory_map)
+        table = table.merge(pheno, on="participant_id", how="left")
+    count(rows=len(table))
+    return table
+
+
+def _expand_roots(roots):
+    """
+    BIDS roots from a glob pattern or a list of paths / patterns
+    """
+    if isinstance(roots, (str, Path)):
+        roots = [roots]
+    expanded = []
+    for root in roots:
+        matches = sorted(glob.glob(str(root))) if glob.has_magic(str(root)) else [root]
+        expanded += [
+            Path(m) for m in matches if (Path(m) / "participants.tsv").is_file()
+        ]
+    return expanded
+
+
+def _where_mask(table, where):
+    """
+    rows of table matching all conditions in where. a condition is a value or
+    a set / list / tuple of values; no row matches a condition on a column
+    table does not have.
+    """
+    mask = pd.Series(True, index=table.index)
+    for column, values in where.items():
+        if column not in table.keys():
+            mask &= False
+        elif isinstance(values, (set, frozenset, list, tuple)):
+            mask &= table[column].isin(values)
+        else:
+            mask &= table[column] == values
+    return mask
+
+
+def _read_pooled_tsv(tsv_file, dtypes, needed):
+    """
+    read the columns of tsv_file in needed (all if None) plus participant_id.
+    returns None if tsv_file has no needed column.
+    """
+    header = pd.read_csv(tsv_file, sep="\t", nrows=0).columns
+    usecols = [k for k in header if needed is None or k in needed]
+    if "participant_id" not in usecols:
+        usecols.insert(0, "participant_id")
+    if len(usecols) < 2 and tsv_file.name != "participants.tsv":
+        return None
+    count(files_read=1, bytes_read=tsv_file.stat().st_size)
+    return pd.read_csv(
+        tsv_file,
+        sep="\t",
+        usecols=usecols,
+        dtype={k: v for k, v in dtypes.items() if k in usecols},
+    )
+
+
+def _read_pooled_root(BIDS_root, columns, where, needed):
+    """
+    pooled table of one root, and the where columns found in its files
+    """
+    participants = _read_pooled_tsv(
+        BIDS_root / "participants.tsv", {"age": "Int64"}, needed
+    )
+    found = {k for k in where if k in participants.keys()}
+    table = participants[_where_mask(participants, {k: where[k] for k in found})]
+    pheno_files = sorted((BIDS_root / "phenotype").glob("*.tsv"))
+    # no participant left to join: the phenotype files are not read, only
+    # their headers if needed to tell a missing where column from an empty root
+    if table.empty:
+        for pheno_file in pheno_files:
+            if found != set(where):
+                header = pd.read_csv(pheno_file, sep="\t", nrows=0).columns
+                found |= set(where) & set(header)
+    else:
+        for pheno_file in pheno_files:
+            dtypes = pheno_dtypes.get(pheno_file.with_suffix("").name, {})
+            pheno = _read_pooled_tsv(pheno_file, dtypes, needed)
+            if pheno is not None:
+                table = table.merge(pheno, on="participant_id", how="left")
+                found |= set(where) & set(pheno.keys())
+        pheno_where = {k: v for k, v in where.items() if k not in participants}
+        if pheno_where:
+            table = table[_where_mask(table, pheno_where)]
+    if columns is not None:
+        table = table.reindex(columns=["participant_id"] + columns)
+    return table.reset_index(drop=True), found
+
+
+def iter_pooled(roots, columns=None, where=None, n_jobs=None):
+    """
+    one DataFrame per BIDS root: participants joined with the phenotype
+    tables on participant_id, as in pooled_table. roots are read by a thread
+    pool with n_jobs workers, at most n_jobs roots are held in memory ahead of
+    the consumer. roots without a where column yield no rows; a where column
+    that no root has raises KeyError once all roots are read.
+    """
+    roots = _expand_roots(roots)
+    where = where or {}
+    if columns is not None:
+        columns = [k for k in columns if k != "participant_id"]
+    needed = None if columns is None else set(columns) | set(where)
+    n_jobs = n_jobs or min(32, (os.cpu_count() or 1) + 4)
+
+    found = set()
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending = []
+        for BIDS_root in roots:
+            pending.append(
+                pool.submit(_read_pooled_root, BIDS_root, columns, where, needed)
+            )
+            if len(pending) > n_jobs:
+                table, root_found = pending.pop(0).result()
+                found |= root_found
+                yield table
+        for future in pending:
+            table, root_found = future.result()
+            found |= root_found
+            yield table
+    missing = [k for k in where if k not in found]
+    if roots and missing:
+        raise KeyError(f"where column(s) {missing} not in any table of the pool")
+
+
+@traced
+def pooled_table(roots, columns=None, where=None, n_jobs=None, lazy=False):
+    """
+    participants and phenotype scores pooled over many BIDS roots.
+
+    roots is a glob pattern or a list of BIDS roots / patterns (folders
+    without participants.tsv are skipped). only participant_id and columns
+    (all if None) are read from each file, phenotype files without any of
+    them are not read at all. where maps column names to a value or a set of
+    values, e.g. {"lab": {"ab", "cd"}}; participants.tsv conditions are
+    applied before the phenotype files are read. a root without a where
+    column contributes no rows, a where column that no root has raises
+    KeyError. pheno_dtypes (Int64 scores)
+    and Int64 age are applied while parsing.
+    returns one DataFrame, or with lazy=True an iterator of one DataFrame per
+    root (see iter_pooled).
+    """
+    tables = iter_pooled(roots, columns=columns, where=where, n_jobs=n_jobs)
+    if lazy:
+        return tables
+    tables = list(tables)
+    if not tables:
+        return pd.DataFrame(columns=["participant_id"] + list(columns or []))
+    table = pd.concat(tables, ignore_index=True)
+    count(rows=len(table))
+    return table
@@ -0,0 +1,201 @@
+"""
+opt-in timing / profiling instrumentation.
+
+public functions of this package are wrapped in spans that record wall time
+and counters (rows, files, bytes read/written). tracing is off by default and
+costs a flag check per call; after enable_tracing() every finished span is
+logged to the 'eegmanylabs_bids' logger and kept for export_trace(), which
+writes a json trace (chrome trace event format, viewable in perfetto or
+chrome://tracing).
+
+usage:
+from eegmanylabs_bids import bids_trace
+bids_trace.enable_tracing()
+...
+bids_trace.export_trace("trace.json")
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+import contextvars
+import contextlib
+
+logger = logging.getLogger("eegmanylabs_bids")
+
+_enabled = False
+_spans = []
+_lock = threading.Lock()
+_current = contextvars.ContextVar("eegmanylabs_bids_span", default=None)
+_ids = iter(range(1, 1 << 62))
+
+
+class Span:
+    """
+    one timed call: name, attributes, counters and parent span id
+    """
+
+    def __init__(self, name, attrs, parent):
+        self.id = next(_ids)
+        self.name = name
+        self.attrs = attrs
+        self.counts = {}
+        self.parent = parent.id if parent is not None else None
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def add(self, **counts):
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "thread": self.thread,
+            "attrs": self.attrs,
+            "counts": self.counts,
+            "error": self.error,
+        }
+
+
+def enable_tracing():
+    global _enabled
+    _enabled = True
+
+
+def disable_tracing():
+    global _enabled
+    _enabled = False
+
+
+def is_tracing():
+    return _enabled
+
+
+def reset_trace():
+    with _lock:
+        _spans.clear()
+
+
+def _finish(s):
+    with _lock:
+        _spans.append(s.as_dict())
+    fields = dict(s.attrs, **s.counts)
+    if s.error:
+        fields["error"] = s.error
+    logger.info(
+        "%s %.4fs %s",
+        s.name,
+        s.duration,
+        " ".join(f"{k}={v}" for k, v in fields.items()),
+    )
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    time the enclosed block as a span (nested under the current span).
+    yields the Span, or None if tracing is disabled.
+    """
+    if not _enabled:
+        yield None
+        return
+    s = Span(name, attrs, _current.get())
+    token = _current.set(s)
+    t0 = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        s.duration = time.perf_counter() - t0
+        _current.reset(token)
+        _finish(s)
+
+
+def count(**counts):
+    """
+    add to the counters (rows, files, bytes_read, ...) of the current span
+    """
+    if _enabled:
+        s = _current.get()
+        if s is not None:
+            s.add(**counts)
+
+
+def annotate(**attrs):
+    """
+    set attributes (e.g. questionnaire name) of the current span
+    """
+    if _enabled:
+        s = _current.get()
+        if s is not None:
+            s.attrs.update(attrs)
+
+
+def record(name, duration, **counts):
+    """
+    add a finished span measured elsewhere (e.g. in a worker process)
+    """
+    if not _enabled:
+        return
+    s = Span(name, {}, _current.get())
+    s.start -= duration
+    s.duration = duration
+    s.add(**counts)
+    _finish(s)
+
+
+def traced(func):
+    """
+    decorator: run every call of func in a span named module.function
+    """
+    name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def get_trace():
+    """
+    finished spans as a list of dicts
+    """
+    with _lock:
+        return list(_spans)
+
+
+def export_trace(file):
+    """
+    write finished spans as json in chrome trace event format
+    """
+    pid = os.getpid()
+    events = [
+        {
+            "name": s["name"],
+            "ph": "X",
+            "ts": s["start"] * 1e6,
+            "dur": s["duration"] * 1e6,
+            "pid": pid,
+            "tid": s["thread"],
+            "args": dict(s["attrs"], **s["counts"], id=s["id"], parent=s["parent"]),
+        }
+        for s in get_trace()
+    ]
+    with open(file, "w") as f:
+        json.dump({"traceEvents": events}, f)
@@ -11,159 +11,945 @@ d.welke@leeds.ac.uk
 https://github.com/dominikwelke
 """
 
+import os
+import re
+import json
+import contextlib
 import shutil
-import pandas as pd
+import tempfile
 
 from pathlib import Path
 from datetime import datetime
-from bids_validator import BIDSValidator
+from dataclasses import dataclass, field
 
-from .bids_phenotype import pheno_dtypes
+from .bids_init import read_resource
+from .bids_trace import traced, span, count
+
+# pandas, bids_validator and the phenotype module are imported inside the
+# functions that need them, to keep e.g. update_changes cheap to import
 
 BIDS_readme = (Path(__file__).parents[0] / "bids_readme.txt").resolve()
 
 
+def atomic_write(file, write):
+    """
+    call write(tmp_path) on a temp file next to file, then rename it into place.
+    readers never see a half-written file.
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=file.parent, prefix=f".{file.name}.")
+    os.close(fd)
+    try:
+        if file.exists():
+            shutil.copymode(file, tmp_file)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_file, 0o666 & ~umask)
+        write(Path(tmp_file))
+        os.replace(tmp_file, file)
+    except BaseException:
+        Path(tmp_file).unlink(missing_ok=True)
+        raise
+
+
+@contextlib.contextmanager
+def _file_lock(lock_file):
+    """
+    exclusive lock on lock_file (created if missing) for the enclosed block
+    """
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, "a+") as f:
+        try:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        yield
+
+
+# structured change log: one json line per version, oldest first
+changes_log = Path("derivatives") / "changes.jsonl"
+
+
+def _parse_changes(text):
+    """
+    entries {version, date, messages} of a BIDS CHANGES text, oldest first.
+    a version line is 'version<whitespace>date' (a separator other than a tab
+    is kept as 'sep'); indented and blank lines are messages of the version
+    above, stored without a single leading tab. raises ValueError if the text
+    cannot be rendered back unchanged (e.g. text above the first version).
+    """
+    entries = []
+    for line in text.splitlines():
+        header = re.fullmatch(r"(v?\d\S*)(\s+)(\S.*)", line)
+        if header is not None:
+            version, sep, date = header.groups()
+            entries.append({"version": version, "date": date, "messages": []})
+            if sep != "\t":
+                entries[-1]["sep"] = sep
+        elif entries:
+            message = line[1:] if line[:1] == "\t" and line[1:2].strip() else line
+            entries[-1]["messages"].append(message)
+    entries = entries[::-1]
+    if _render_changes(entries).rstrip() != text.rstrip():
+        raise ValueError(
+            "CHANGES has lines that are not 'version<whitespace>date' or an "
+            "indented message below one; fix it by hand, it was not modified"
+        )
+    return entries
+
+
+def _render_changes(entries):
+    """
+    BIDS CHANGES text (newest version first) of change log entries
+    """
+    lines = []
+    for e in reversed(entries):
+        sep = e.get("sep", "\t")
+        lines.append(f"{e['version']}{sep}{e['date']}\n")
+        for m in e["messages"]:
+            # indented (e.g. space-indented) and blank lines are kept as is
+            lines.append(f"{m}\n" if m[:1].isspace() or not m else f"\t{m}\n")
+    return "".join(lines)
+
+
+def _read_changes_log(log_file):
+    entries = []
+    if log_file.is_file():
+        for line in log_file.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # incomplete last line of an interrupted append
+                break
+    return entries
+
+
+def _next_version(entries):
+    if not entries:
+        return "0.0.0"
+    v_old = entries[-1]["version"].split(".")
+    return ".".join(v_old[:-1] + [str(int(v_old[-1]) + 1)])
+
+
+def _infer_dtypes(tsv):
+    """
+    Int64 for float columns holding only whole numbers and missing values,
+    i.e. integer columns with 'n/a' entries, so they are not written back
+    as '1.0'. used for phenotype tables not listed in pheno_dtypes.
+    """
+    import pandas as pd
+
+    dtypes = {}
+    for k in tsv.keys():
+        column = tsv[k]
+        if pd.api.types.is_float_dtype(column.dtype) and column.isna().any():
+            values = column.dropna()
+            if (values == values.round()).all():
+                dtypes[k] = "Int64"
+    return dtypes
+
+
+def _cast_table(tsv, dtypes):
+    """
+    cast the columns of tsv to dtypes. Int64 columns are parsed as numbers
+    first ('n/a' and other non-numeric entries become missing); if they hold
+    fractional values (e.g. age 25.5) they become Float64 instead of being
+    truncated.
+    """
+    import pandas as pd
+
+    tsv = tsv.copy()
+    for k, dtype in dtypes.items():
+        if k not in tsv.keys():
+            continue
+        if dtype == "Int64":
+            column = pd.to_numeric(tsv[k], errors="coerce").astype("Float64")
+            values = column.dropna()
+            tsv[k] = column.astype("Int64" if (values % 1 == 0).all() else "Float64")
+        else:
+            tsv[k] = tsv[k].astype(dtype)
+    return tsv
+
+
+def _sort_tsv(tsv_file):
+    """
+    sort the rows of a TSV by participant_id as text, so values are written
+    back exactly as read. returns False if the file was already sorted (it
+    is not rewritten), True if it was rewritten, and None for files with
+    quoted fields, which need a full parse (see BIDSDataset.sort).
+    """
+    text = tsv_file.read_text()
+    if '"' in text:
+        return None
+    lines = text.splitlines()
+    if not lines:
+        return False
+    header, rows = lines[0], [line for line in lines[1:] if line]
+    i = header.split("\t").index("participant_id")
+    keys = [row.split("\t", i + 1)[i] for row in rows]
+    if all(a <= b for a, b in zip(keys, keys[1:])):
+        return False
+    order = sorted(range(len(rows)), key=keys.__getitem__)
+    text = "\n".join([header] + [rows[j] for j in order]) + "\n"
+    atomic_write(tsv_file, lambda tmp: tmp.write_text(text))
+    return True
+
+
+class BIDSDataset:
+    """
+    in-memory session on a BIDS folder.
+
+    participants.tsv, phenotype tables, text files (CHANGES, README) and json
+    sidecars are loaded lazily on first access and cached. edits only mark
+    files as dirty; flush() writes the changed files, each via temp file and
+    rename. used as context manager, the session is flushed on clean exit.
+    """
+
+    def __init__(self, BIDS_root):
+        self.BIDS_root = Path(BIDS_root)
+        self._tables = {}
+        self._texts = {}
+        self._sidecars = {}
+        self._dirty = set()
+        self._purge_phenotype = False
+        self._changes = []
+        self._inferred_dtypes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    # loading
+    def _table_dtypes(self, tsv_file):
+        from .bids_phenotype import pheno_dtypes
+
+        if tsv_file == self.BIDS_root / "participants.tsv":
+            return {"age": "Int64"}
+        name = tsv_file.with_suffix("").name
+        if name in pheno_dtypes:
+            return pheno_dtypes[name]
+        return self._inferred_dtypes.get(tsv_file, {})
+
+    def _is_known_table(self, tsv_file):
+        from .bids_phenotype import pheno_dtypes
+
+        return (
+            tsv_file == self.BIDS_root / "participants.tsv"
+            or tsv_file.with_suffix("").name in pheno_dtypes
+        )
+
+    def phenotype_files(self):
+        phenotype_folder = self.BIDS_root / "phenotype"
+        files = set(f for f in self._tables if f.parent == phenotype_folder)
+        if phenotype_folder.is_dir() and not self._purge_phenotype:
+            files.update(phenotype_folder.glob("*.tsv"))
+        return sorted(files)
+
+    def table(self, tsv_file):
+        import pandas as pd
+
+        tsv_file = self.BIDS_root / tsv_file
+        if tsv_file not in self._tables:
+            name = str(tsv_file.relative_to(self.BIDS_root))
+            with span("bids_utils.BIDSDataset.table", file=name):
+                dtypes = self._table_dtypes(tsv_file)
+                try:
+                    tsv = pd.read_csv(tsv_file, sep="\t", dtype=dtypes)
+                except (TypeError, ValueError):
+                    # e.g. a fractional age: parse leniently, see _cast_table
+                    tsv = _cast_table(pd.read_csv(tsv_file, sep="\t"), dtypes)
+                if not self._is_known_table(tsv_file):
+                    self._inferred_dtypes[tsv_file] = _infer_dtypes(tsv)
+                    tsv = tsv.astype(self._inferred_dtypes[tsv_file])
+                self._tables[tsv_file] = tsv
+                count(
+                    bytes_read=tsv_file.stat().st_size,
+                    rows_read=len(self._tables[tsv_file]),
+                )
+        return self._tables[tsv_file]
+
+    @property
+    def participants(self):
+        return self.table("participants.tsv")
+
+    def tables(self):
+        """
+        participants.tsv plus all phenotype tables, keyed by file path
+        """
+        tsv_files = [self.BIDS_root / "participants.tsv"] + self.phenotype_files()
+        return {tsv_file: self.table(tsv_file) for tsv_file in tsv_files}
+
+    def text(self, name):
+        file = self.BIDS_root / name
+        if file not in self._texts:
+            self._texts[file] = file.read_text() if file.is_file() else ""
+        return self._texts[file]
+
+    def sidecar(self, json_file):
+        json_file = self.BIDS_root / json_file
+        if json_file not in self._sidecars:
+            with json_file.open("r") as f:
+                self._sidecars[json_file] = json.load(f)
+        return self._sidecars[json_file]
+
+    # editing
+    def set_table(self, tsv_file, table):
+        tsv_file = self.BIDS_root / tsv_file
+        self._tables[tsv_file] = table
+        self._dirty.add(tsv_file)
+
+    def set_text(self, name, text):
+        file = self.BIDS_root / name
+        self._texts[file] = text
+        self._dirty.add(file)
+
+    def set_sidecar(self, json_file, sidecar):
+        json_file = self.BIDS_root / json_file
+        self._sidecars[json_file] = sidecar
+        self._dirty.add(json_file)
+
+    def drop_participants(self, participant_ids):
+        participant_ids = set(participant_ids)
+        if not participant_ids:
+            return
+        for tsv_file, tsv in self.tables().items():
+            drop = tsv.participant_id.isin(participant_ids)
+            if drop.any():
+                self.set_table(tsv_file, tsv[~drop].reset_index(drop=True))
+
+        for participant_id in sorted(participant_ids):
+            print(f"{participant_id} removed from BIDS dataset")
+
+    def add_participants(self, records):
+        import pandas as pd
+
+        records = pd.DataFrame.from_records(list(records))
+        if records.empty:
+            return
+        assert "participant_id" in records.keys()
+
+        for tsv_file, tsv in self.tables().items():
+            dtypes = self._table_dtypes(tsv_file)
+            new = records.reindex(columns=tsv.columns)
+            tsv = _cast_table(pd.concat([tsv, new], ignore_index=True), dtypes)
+            self.set_table(tsv_file, tsv)
+        self.sort()
+
+        for participant_id in records.participant_id:
+            print(f"{participant_id} added to BIDS dataset")
+
+    def sort(self, tsv_files=None):
+        """
+        sort tables (default: all) by participant_id, if not sorted yet
+        """
+        if tsv_files is None:
+            tsv_files = self.tables()
+        for tsv_file in tsv_files:
+            tsv = self.table(tsv_file)
+            if not tsv.participant_id.is_monotonic_increasing:
+                tsv = tsv.sort_values("participant_id", ignore_index=True)
+                self.set_table(tsv_file, tsv)
+
+    def purge(self):
+        participants = self.participants
+        self.set_table("participants.tsv", participants.iloc[0:0])
+        for tsv_file in self.phenotype_files():
+            self._tables.pop(tsv_file, None)
+            self._dirty.discard(tsv_file)
+        self._purge_phenotype = (self.BIDS_root / "phenotype").is_dir()
+
+    def update_changes(self, message="- add questionnaires to phenotype folder."):
+        """
+        queue one message (or a list of messages) for the change log. all
+        messages queued until flush() are logged under one new version.
+        """
+        if isinstance(message, str):
+            message = [message]
+        self._changes.extend(message)
+
+    def update_readme(self):
+        self.set_text("README", read_resource("bids_readme.txt"))
+
+    # writing
+    @traced
+    def flush(self):
+        """
+        write all changed files to disk
+        """
+        if self._purge_phenotype:
+            shutil.rmtree(self.BIDS_root / "phenotype")
+            (self.BIDS_root / "phenotype").mkdir(parents=True)
+            self._purge_phenotype = False
+
+        for file in sorted(self._dirty):
+            if file in self._tables:
+                atomic_write(
+                    file,
+                    lambda tmp, tsv=self._tables[file]: tsv.to_csv(
+                        tmp, sep="\t", index=False, na_rep="n/a"
+                    ),
+                )
+            elif file in self._sidecars:
+                atomic_write(
+                    file,
+                    lambda tmp, sidecar=self._sidecars[file]: tmp.write_text(
+                        json.dumps(sidecar, indent=4)
+                    ),
+                )
+            else:
+                atomic_write(
+                    file, lambda tmp, text=self._texts[file]: tmp.write_text(text)
+                )
+            count(files_written=1, bytes_written=file.stat().st_size)
+        self._dirty.clear()
+
+        if self._changes:
+            self._flush_changes()
+
+    def _flush_changes(self):
+        """
+        append the queued messages as one version to derivatives/changes.jsonl
+        and regenerate CHANGES from it, under a lock on derivatives/changes.lock.
+        if CHANGES does not match the log (no log yet, or edited by hand), the
+        log is first re-created from CHANGES.
+        """
+        changes_file = self.BIDS_root / "CHANGES"
+        log_file = self.BIDS_root / changes_log
+        with _file_lock(log_file.with_suffix(".lock")):
+            text = changes_file.read_text() if changes_file.is_file() else ""
+            entries = _read_changes_log(log_file)
+            if _render_changes(entries).rstrip() != text.rstrip():
+                entries = _parse_changes(text)
+                atomic_write(
+                    log_file,
+                    lambda tmp: tmp.write_text(
+                        "".join(json.dumps(e) + "\n" for e in entries)
+                    ),
+                )
+            entry = {
+                "version": _next_version(entries),
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "messages": self._changes,
+            }
+            with log_file.open("a") as f:
+                f.write(json.dumps(entry) + "\n")
+            entries.append(entry)
+            text = _render_changes(entries)
+            atomic_write(changes_file, lambda tmp: tmp.write_text(text))
+        count(files_written=2)
+        self._texts[changes_file] = text
+        self._dirty.discard(changes_file)
+        self._changes = []
+
+
+@traced
+def drop_participants(BIDS_root, participant_ids):
+    """
+    remove several participants from participants.tsv and all phenotype tables.
+    every table is read and written at most once.
+    """
+    with BIDSDataset(BIDS_root) as dataset:
+        dataset.drop_participants(participant_ids)
+
+
+@traced
 def drop_participant(BIDS_root, participant_id):
-    participants_tsv = pd.read_csv(BIDS_root / "participants.tsv", sep="\t")
-    participants_tsv = participants_tsv[
-        participants_tsv.participant_id != participant_id
-    ]
-    participants_tsv.to_csv(
-        BIDS_root / "participants.tsv", sep="\t", index=False, na_rep="n/a"
-    )
+    drop_participants(BIDS_root, [participant_id])
 
-    phenotype_folder = BIDS_root / "phenotype"
-    if phenotype_folder.is_dir():
-        for pheno_file in phenotype_folder.glob("*.tsv"):
-            pheno_tsv = pd.read_csv(pheno_file, sep="\t")
-            pheno_tsv = pheno_tsv[pheno_tsv.participant_id != participant_id]
-            pheno_tsv.to_csv(pheno_file, sep="\t", index=False, na_rep="n/a")
 
-    print(f"{participant_id} removed from BIDS dataset")
+@traced
+def add_participants(BIDS_root, records):
+    """
+    add several participants to participants.tsv and all phenotype tables.
+    records is an iterable of dicts with key 'participant_id'; keys that are
+    not columns of a table are ignored, missing columns are set to 'n/a'.
+    every table is read, sorted and written exactly once.
+    """
+    with BIDSDataset(BIDS_root) as dataset:
+        dataset.add_participants(records)
 
 
+@traced
 def add_participant(BIDS_root, participant_id, **kwargs):
     if not isinstance(kwargs, dict):
         kwargs = {}
     kwargs["participant_id"] = participant_id
-
-    participants_tsv = pd.read_csv(BIDS_root / "participants.tsv", sep="\t").to_dict(
-        "list"
-    )
-    for k in participants_tsv.keys():
-        participants_tsv[k].append(kwargs[k] if (k in kwargs.keys()) else "n/a")
-    pd.DataFrame(participants_tsv).to_csv(
-        BIDS_root / "participants.tsv", sep="\t", index=False, na_rep="n/a"
-    )
-
-    phenotype_folder = BIDS_root / "phenotype"
-    if phenotype_folder.is_dir():
-        for pheno_file in phenotype_folder.glob("*.tsv"):
-            pheno_tsv = pd.read_csv(pheno_file, sep="\t").to_dict("list")
-            for k in pheno_tsv.keys():
-                pheno_tsv[k].append(kwargs[k] if (k in kwargs.keys()) else "n/a")
-            pd.DataFrame(pheno_tsv).to_csv(
-                pheno_file, sep="\t", index=False, na_rep="n/a"
-            )
-
-    sort_bids(BIDS_root)
-    print(f"{participant_id} added to BIDS dataset")
+    add_participants(BIDS_root, [kwargs])
 
 
+@traced
 def update_changes(BIDS_root, message="- add questionnaires to phenotype folder."):
-    date = datetime.now().strftime("%Y-%m-%d")
-    hist = (BIDS_root / "CHANGES").read_text()
-    if hist == "":
-        v_new = "0.0.0"
-    else:
-        v_old = hist.split("\t")[0].split(".")
-        v_new = ".".join(v_old[:-1] + [str(int(v_old[-1]) + 1)])
-    log = f"{v_new}\t{date}\n\t{message}\n"
+    """
+    add a new version with one message (or a list of messages) to CHANGES,
+    see BIDSDataset.update_changes
+    """
+    with BIDSDataset(BIDS_root) as dataset:
+        dataset.update_changes(message)
 
-    with (BIDS_root / "CHANGES").open("w+") as f:
-        f.write(log + hist)
 
+@traced
+def read_changes(BIDS_root):
+    """
+    change log entries {version, date, messages}, oldest first
+    """
+    BIDS_root = Path(BIDS_root)
+    entries = _read_changes_log(BIDS_root / changes_log)
+    changes_file = BIDS_root / "CHANGES"
+    text = changes_file.read_text() if changes_file.is_file() else ""
+    if _render_changes(entries).rstrip() != text.rstrip():
+        entries = _parse_changes(text)
+    # blank lines between versions are kept for CHANGES only
+    return [dict(e, messages=[m for m in e["messages"] if m.strip()]) for e in entries]
 
+
+@traced
 def update_readme(BIDS_root):
     # copy README file
-    with (BIDS_root / "README").open("w+") as f:
-        f.write(BIDS_readme.read_text())  # for text files
+    with BIDSDataset(BIDS_root) as dataset:
+        dataset.update_readme()
 
 
+@traced
 def purge_folder(BIDS_root):
-    participants_tsv = pd.read_csv(BIDS_root / "participants.tsv", sep="\t").to_dict(
-        "list"
-    )
-    participants_tsv = {k: [] for k in participants_tsv.keys()}
-    pd.DataFrame(participants_tsv).to_csv(
-        BIDS_root / "participants.tsv", sep="\t", index=False, na_rep="n/a"
-    )
+    with BIDSDataset(BIDS_root) as dataset:
+        dataset.purge()
 
-    if (BIDS_root / "phenotype").is_dir():
-        shutil.rmtree(BIDS_root / "phenotype")
-        (BIDS_root / "phenotype").mkdir(parents=True)
 
+@traced
+def sort_bids(BIDS_root, n_jobs=None):
+    """
+    sort participants.tsv and all phenotype tables by participant_id.
+    files are checked and sorted as text by a thread pool with n_jobs
+    workers; files that are already sorted are only read.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-def sort_bids(BIDS_root):
-    # participants_tsv
-    participants_tsv = pd.read_csv(
-        BIDS_root / "participants.tsv", sep="\t", dtype={"age": "Int64"}
-    )
-    participants_tsv.sort_values("participant_id", inplace=True)
-    participants_tsv.to_csv(
-        BIDS_root / "participants.tsv", sep="\t", index=False, na_rep="n/a"
+    BIDS_root = Path(BIDS_root)
+    tsv_files = [BIDS_root / "participants.tsv"]
+    tsv_files += sorted((BIDS_root / "phenotype").glob("*.tsv"))
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        rewritten = list(pool.map(_sort_tsv, tsv_files))
+    count(files=len(tsv_files), files_written=sum(r is True for r in rewritten))
+
+    quoted = [f for f, r in zip(tsv_files, rewritten) if r is None]
+    if quoted:
+        with BIDSDataset(BIDS_root) as dataset:
+            dataset.sort(quoted)
+
+
+@traced
+def plan_consolidation(dataset, manifest=None):
+    """
+    compare participants.tsv, the sub-* folders and every phenotype table.
+    the target set of participants are the sub-* folders, taken from manifest
+    (a BIDSManifest) instead of listing BIDS_root if given.
+
+    returns a diff plan dict:
+        to_drop:   participants.tsv entries without eeg folder
+        to_add:    eeg folders without participants.tsv entry
+        phenotype: {phenotype file name: {"orphans": [...], "missing": [...]}}
+                   rows without eeg folder / eeg folders without row
+    """
+    import pandas as pd
+
+    if manifest is not None:
+        ids_eeg = pd.Index(manifest.subjects())
+    else:
+        ids_eeg = pd.Index(
+            sorted(
+                entry.name
+                for entry in os.scandir(dataset.BIDS_root)
+                if entry.is_dir() and entry.name.startswith("sub-")
+            )
+        )
+    ids_tsv = pd.Index(dataset.participants["participant_id"])
+    plan = {
+        "to_drop": list(ids_tsv.difference(ids_eeg)),
+        "to_add": list(ids_eeg.difference(ids_tsv)),
+        "phenotype": {},
+    }
+    for pheno_file in dataset.phenotype_files():
+        ids_pheno = pd.Index(dataset.table(pheno_file)["participant_id"])
+        plan["phenotype"][pheno_file.with_suffix("").name] = {
+            "orphans": list(ids_pheno.difference(ids_eeg)),
+            "missing": list(ids_eeg.difference(ids_pheno)),
+        }
+    return plan
+
+
+@traced
+def apply_consolidation(dataset, plan, **kwargs):
+    """
+    apply a plan from plan_consolidation to a BIDSDataset, editing every
+    table once. new participants.tsv rows get lab (first 3 characters of the
+    label), species and kwargs; new phenotype rows are empty.
+    """
+    import pandas as pd
+
+    labels = pd.Series(plan["to_add"], dtype=object).str.removeprefix("sub-")
+    new_participants = pd.DataFrame(
+        {
+            "participant_id": plan["to_add"],
+            "lab": labels.str[:3],
+            "species": "homo sapiens",
+        }
     )
+    for k, v in kwargs.items():
+        new_participants[k] = v
+    changes = {"participants.tsv": (plan["to_drop"], new_participants)}
+    for pheno_name, diff in plan["phenotype"].items():
+        changes[f"phenotype/{pheno_name}.tsv"] = (
+            diff["orphans"],
+            pd.DataFrame({"participant_id": diff["missing"]}),
+        )
 
-    # phenotype
-    for quest_tsv_file in (BIDS_root / "phenotype").glob("*.tsv"):
-        quest_tsv = pd.read_csv(
-            quest_tsv_file,
-            sep="\t",
-            dtype=pheno_dtypes[quest_tsv_file.with_suffix("").name],
+    for tsv_file, (drop, new) in changes.items():
+        if not drop and new.empty:
+            continue
+        tsv = dataset.table(tsv_file)
+        tsv = pd.concat(
+            [tsv[~tsv.participant_id.isin(drop)], new.reindex(columns=tsv.columns)],
+            ignore_index=True,
+        )
+        tsv = _cast_table(tsv, dataset._table_dtypes(dataset.BIDS_root / tsv_file))
+        dataset.set_table(
+            tsv_file, tsv.sort_values("participant_id", ignore_index=True)
         )
-        quest_tsv.sort_values("participant_id", inplace=True)
-        quest_tsv.to_csv(quest_tsv_file, sep="\t", index=False, na_rep="n/a")
 
 
-def consolidate_bids(BIDS_root, verbose=True, **kwargs):
+@traced
+def consolidate_bids(BIDS_root, verbose=True, dry_run=False, manifest=None, **kwargs):
+    """
+    make participants.tsv and the phenotype tables match the sub-* folders:
+    remove entries with missing eeg, add entries for eeg without entry.
+    each file is written at most once; with dry_run=True nothing is written.
+    returns the diff plan (see plan_consolidation).
+    """
     if verbose:
         print(
             "\nupdating BIDS participants.tsv (removing entries with missing eeg / adding entries with missing questionnaires):"
         )
-    participant_ids_tsv = list(
-        pd.read_csv(BIDS_root / "participants.tsv", sep="\t")["participant_id"]
-    )
-    participant_ids_eeg = [f.name for f in BIDS_root.glob("sub-*")]
-    for participant_id in participant_ids_tsv:
-        if participant_id not in participant_ids_eeg:
+    dataset = BIDSDataset(BIDS_root)
+    plan = plan_consolidation(dataset, manifest=manifest)
+    if verbose:
+        for participant_id in plan["to_drop"]:
             print(participant_id, "no eeg file")
-            drop_participant(BIDS_root, participant_id)
-    for participant_id in participant_ids_eeg:
-        if participant_id not in participant_ids_tsv:
-            print("sub-" + participant_id, "no entry in participants.tsv")
-            add_participant(
-                BIDS_root,
-                "sub-" + participant_id,
-                lab=participant_id[:3],
-                species="homo sapiens",
-                **kwargs,
-            )
+        for participant_id in plan["to_add"]:
+            print(participant_id, "no entry in participants.tsv")
+        for pheno_name, diff in plan["phenotype"].items():
+            if diff["orphans"] or diff["missing"]:
+                print(
+                    f"phenotype/{pheno_name}.tsv: {len(diff['orphans'])} entries "
+                    f"without eeg, {len(diff['missing'])} eeg without entry"
+                )
+    if not dry_run:
+        apply_consolidation(dataset, plan, **kwargs)
+        dataset.flush()
+    return plan
 
 
-def validate_bids(BIDS_root, verbose=True):
-    validator = BIDSValidator()
-    files = [
-        f"/{f.relative_to(BIDS_root)}" for f in BIDS_root.rglob("*") if f.is_file()
-    ]
-    files = [f for f in files if ".DS_Store" not in f]
+@dataclass
+class ValidationReport:
+    """
+    result of check_bids: all files (BIDS-relative paths, sorted), the ones
+    that are not BIDS compatible, and how many verdicts came from the cache
+    """
+
+    files: list = field(default_factory=list)
+    invalid: list = field(default_factory=list)
+    n_cached: int = 0
+
+    @property
+    def n_checked(self):
+        return len(self.files) - self.n_cached
+
+    @property
+    def valid(self):
+        return len(self.invalid) == 0
+
+
+def _scan_files(BIDS_root):
+    """
+    all files below BIDS_root as '/relative/path', walked with os.scandir
+    """
+    files = []
+    stack = [(str(BIDS_root), "")]
+    while stack:
+        folder, prefix = stack.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, f"{prefix}/{entry.name}"))
+                elif entry.is_file() and entry.name != ".DS_Store":
+                    files.append(f"{prefix}/{entry.name}")
     files.sort()
-    validation = [validator.is_bids(f) for f in files]
+    return files
+
+
+def _is_bids_chunk(files):
+    from bids_validator import BIDSValidator
+
+    validator = BIDSValidator()
+    return [validator.is_bids(f) for f in files]
+
+
+def _validation_cache_file(BIDS_root):
+    """
+    validation cache of BIDS_root in the user cache folder, outside the
+    dataset (which may be on a read-only mount)
+    """
+    import hashlib
+
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    key = hashlib.sha1(str(BIDS_root.resolve()).encode()).hexdigest()[:16]
+    return cache_home / "eegmanylabs_bids" / f"bids_validation_{key}.json"
+
+
+@traced
+def check_bids(BIDS_root, n_jobs=None, cache=True, chunk_size=2000, manifest=None):
+    """
+    check all file names of a BIDS folder without printing or raising.
+
+    verdicts are cached per dataset in the user cache folder ($XDG_CACHE_HOME
+    or ~/.cache) or in the file given as cache, keyed on the relative path and
+    the bids_validator version, so only new or renamed files are checked.
+    nothing is written to BIDS_root; a cache that cannot be read or written is
+    ignored, cache=False disables it. these are validated in chunks of chunk_size paths by a
+    process pool with n_jobs workers (default: one per CPU).
+    if manifest (a BIDSManifest) is given, its file list is used instead of
+    walking the folder.
+    returns a ValidationReport.
+    """
+    from importlib.metadata import version
+    from concurrent.futures import ProcessPoolExecutor
+
+    BIDS_root = Path(BIDS_root)
+    if cache is True:
+        cache = _validation_cache_file(BIDS_root)
+    validator_version = version("bids_validator")
+
+    verdicts = {}
+    if cache:
+        try:
+            cached = json.loads(Path(cache).read_text())
+            if cached.get("validator_version") == validator_version:
+                verdicts = cached["verdicts"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    files = manifest.file_list() if manifest is not None else _scan_files(BIDS_root)
+    todo = [f for f in files if f not in verdicts]
+    count(files=len(files), files_checked=len(todo))
+    chunks = [todo[i : i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    if n_jobs == 1 or len(chunks) < 2:
+        results = [_is_bids_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_is_bids_chunk, chunks))
+    for chunk, result in zip(chunks, results):
+        verdicts.update(zip(chunk, result))
+
+    if cache and todo:
+        verdicts = {f: verdicts[f] for f in files}
+        text = json.dumps(
+            {"validator_version": validator_version, "verdicts": verdicts}
+        )
+        try:
+            Path(cache).parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(Path(cache), lambda tmp: tmp.write_text(text))
+        except OSError:
+            # e.g. read-only home; the check itself does not need the cache
+            pass
+
+    return ValidationReport(
+        files=files,
+        invalid=[f for f in files if not verdicts[f]],
+        n_cached=len(files) - len(todo),
+    )
+
+
+@traced
+def validate_bids(BIDS_root, verbose=True, **kwargs):
+    """
+    check all file names of a BIDS folder, raise ValueError if any is not
+    BIDS compatible. kwargs are passed to check_bids.
+    """
+    report = check_bids(BIDS_root, **kwargs)
     if verbose:
         print("\nvalidate BIDS format:")
-        for val, file in zip(validation, files):
-            if not val:
-                print(f"{val} - {file}")
+        for file in report.invalid:
+            print(f"False - {file}")
 
-    n_incompatible = len(validation) - sum(validation)
+    n_incompatible = len(report.invalid)
     if n_incompatible != 0:
         raise ValueError(f"{n_incompatible} filename(s) not BIDS compatible!")
+
+
+# snapshots
+# files of these types are copied into snapshots (small, and may be edited in
+# place); all others (eeg recordings) are hardlinked. hardlinked files are
+# safe as long as they are replaced rather than edited in place, which holds
+# for every write done by this package (temp file + rename).
+snapshot_copy_suffixes = {".tsv", ".json", ".jsonl", ".txt", ".md", ".lock", ""}
+
+
+def _snapshot_folder(BIDS_root):
+    """
+    snapshots live next to BIDS_root, so they are not part of the dataset.
+    BIDS_root must be resolved (e.g. Path(".") has no name and parent).
+    """
+    folder = BIDS_root.parent / f"{BIDS_root.name}.snapshots"
+    if folder.is_relative_to(BIDS_root):
+        raise ValueError(f"snapshot folder {folder} would be inside {BIDS_root}")
+    return folder
+
+
+def _tree(folder, exclude=None):
+    """
+    relative paths of all sub-folders and files below folder,
+    without the folder exclude (e.g. the snapshot folder) and its contents
+    """
+    dirs, files = set(), set()
+    for path, dirnames, filenames in os.walk(folder):
+        if exclude is not None:
+            dirnames[:] = [d for d in dirnames if Path(path) / d != exclude]
+        rel = Path(path).relative_to(folder)
+        dirs.update((rel / d).as_posix() for d in dirnames)
+        files.update((rel / f).as_posix() for f in filenames)
+    return dirs, files
+
+
+def _place_file(src, dst):
+    """
+    put src at dst, replacing dst atomically: hardlinked, or copied if its
+    suffix is in snapshot_copy_suffixes or linking fails.
+    returns True if hardlinked.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if src.suffix not in snapshot_copy_suffixes:
+        tmp_file = dst.parent / f".{dst.name}.{os.urandom(4).hex()}"
+        try:
+            os.link(src, tmp_file)
+            os.replace(tmp_file, dst)
+            return True
+        except OSError:
+            tmp_file.unlink(missing_ok=True)
+    atomic_write(dst, lambda tmp: shutil.copy2(src, tmp))
+    return False
+
+
+def _same_file(a, b):
+    if os.path.samefile(a, b):
+        return True
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    import filecmp
+
+    return filecmp.cmp(a, b, shallow=False)
+
+
+def _compare_snapshot(BIDS_root, name):
+    snapshot_root = _snapshot_folder(BIDS_root) / name
+    if not snapshot_root.is_dir():
+        raise FileNotFoundError(f"no snapshot '{name}' of {BIDS_root}")
+    dirs, files = _tree(BIDS_root, exclude=_snapshot_folder(BIDS_root))
+    snapshot_dirs, snapshot_files = _tree(snapshot_root)
+    changes = {
+        "added": sorted(files - snapshot_files),
+        "removed": sorted(snapshot_files - files),
+        "changed": sorted(
+            f
+            for f in files & snapshot_files
+            if not _same_file(BIDS_root / f, snapshot_root / f)
+        ),
+    }
+    return changes, dirs, snapshot_dirs
+
+
+@traced
+def snapshot(BIDS_root, name=None):
+    """
+    record the current state of BIDS_root as snapshot name (default: a
+    timestamp) in the sibling folder <BIDS_root>.snapshots. metadata files
+    are copied, all others hardlinked, so a snapshot costs almost no disk.
+    the snapshot is built in a temp folder and renamed into place.
+    returns the snapshot name.
+    """
+    BIDS_root = Path(BIDS_root).resolve()
+    if name is None:
+        name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    folder = _snapshot_folder(BIDS_root)
+    folder.mkdir(exist_ok=True)
+    if (folder / name).exists():
+        raise FileExistsError(f"snapshot '{name}' of {BIDS_root} already exists")
+
+    tmp_root = Path(tempfile.mkdtemp(dir=folder, prefix=f".{name}."))
+    try:
+        dirs, files = _tree(BIDS_root, exclude=folder)
+        for d in sorted(dirs):
+            (tmp_root / d).mkdir(parents=True, exist_ok=True)
+        n_linked = sum(_place_file(BIDS_root / f, tmp_root / f) for f in files)
+        os.rename(tmp_root, folder / name)
+    except BaseException:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        raise
+    count(files=len(files), files_linked=n_linked)
+    return name
+
+
+def list_snapshots(BIDS_root):
+    """
+    names of all snapshots of BIDS_root, oldest first
+    """
+    folder = _snapshot_folder(Path(BIDS_root).resolve())
+    if not folder.is_dir():
+        return []
+    snapshots = [d for d in folder.iterdir() if d.is_dir() and d.name[0] != "."]
+    return [d.name for d in sorted(snapshots, key=lambda d: d.stat().st_mtime_ns)]
+
+
+@traced
+def diff(BIDS_root, name):
+    """
+    compare BIDS_root with snapshot name. returns a dict of relative paths:
+        added:   files created since the snapshot
+        removed: files deleted since the snapshot
+        changed: files whose content differs
+    """
+    return _compare_snapshot(Path(BIDS_root).resolve(), name)[0]
+
+
+@traced
+def restore(BIDS_root, name):
+    """
+    bring BIDS_root back to snapshot name: changed and removed files are
+    put back, added files and folders are deleted. only files that differ
+    are touched; the snapshot is kept. returns the diff that was undone.
+    """
+    BIDS_root = Path(BIDS_root).resolve()
+    snapshot_root = _snapshot_folder(BIDS_root) / name
+    changes, dirs, snapshot_dirs = _compare_snapshot(BIDS_root, name)
+
+    for f in changes["added"]:
+        (BIDS_root / f).unlink()
+    for d in sorted(dirs - snapshot_dirs, key=len, reverse=True):
+        with contextlib.suppress(OSError):
+            (BIDS_root / d).rmdir()
+    for d in sorted(snapshot_dirs):
+        (BIDS_root / d).mkdir(parents=True, exist_ok=True)
+    for f in changes["changed"] + changes["removed"]:
+        _place_file(snapshot_root / f, BIDS_root / f)
+    count(files_written=len(changes["changed"]) + len(changes["removed"]))
+    return changes
+
+
+def delete_snapshot(BIDS_root, name):
+    shutil.rmtree(_snapshot_folder(Path(BIDS_root).resolve()) / name)